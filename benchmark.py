@@ -0,0 +1,490 @@
+# Нагрузочный тест бота без сети.
+# Запускает настоящее Application из main.py, но вместо api.telegram.org запросы бота уходят на локальный
+# поддельный сервер Bot API, а вместо MongoDB используется коллекция в памяти. N пользователей одновременно
+# проходят викторину целиком; в конце выводятся пропускная способность, перцентили времени обработчиков
+# и память на одну сессию.
+#
+# Пример запуска:
+#   python benchmark.py --users 500 --questions 20
+import argparse # Разбор параметров командной строки
+import asyncio # Библиотека для асинхронного программирования
+import json # Ответы поддельного сервера Bot API и разбор reply_markup
+import os # Путь к временному файлу снимка банка вопросов
+import random # Случайный выбор вариантов ответа
+import tempfile # Временный каталог для снимка банка вопросов в режиме нескольких процессов
+import time # Замер времени
+import tracemalloc # Замер памяти, занимаемой сессиями
+from array import array # Позиции вопросов викторины
+from datetime import datetime, timezone # Даты в сообщениях Telegram
+from urllib.parse import parse_qsl, unquote # Разбор тела запросов python-telegram-bot (form-urlencoded)
+
+from pymongo.errors import ConnectionFailure, OperationFailure # Ошибки недоступной MongoDB и change stream
+from telegram import Update
+
+import main
+
+BENCHMARK_TOKEN = '123456:BENCHMARK' # Токен поддельного бота; к настоящему Telegram запросы не уходят.
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "HistEyeBot", "username": "HistEyeBot"}
+
+
+# --- КОЛЛЕКЦИЯ MONGODB В ПАМЯТИ ---
+# Реализует только те методы motor, которыми пользуется main.py.
+
+class MemoryCursor:
+    """Асинхронный курсор по списку документов."""
+
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        self._docs.sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        self._docs = self._docs[:count]
+        return self
+
+    def __aiter__(self):
+        self._iterator = iter(self._docs)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        return self._docs[:length] if length else list(self._docs)
+
+
+def _matches(doc, flt):
+    """Проверяет документ на соответствие фильтру (поддерживаются равенство и операторы $gte, $in)."""
+    for key, condition in flt.items():
+        value = doc.get(key)
+        if isinstance(condition, dict):
+            if "$gte" in condition and (value is None or value < condition["$gte"]):
+                return False
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return dict(doc)
+    return {key: value for key, value in doc.items() if key == "_id" or projection.get(key)}
+
+
+class MemoryCollection:
+    """Коллекция MongoDB в памяти."""
+
+    def __init__(self):
+        self.docs = {}
+        self.bulk_writes = 0 # Сколько раз вызван bulk_write (для проверки пакетной записи).
+
+    def find(self, flt=None, projection=None, **kwargs):
+        flt = flt or {}
+        return MemoryCursor([_project(doc, projection) for doc in self.docs.values() if _matches(doc, flt)])
+
+    async def find_one(self, flt, projection=None):
+        for doc in self.docs.values():
+            if _matches(doc, flt):
+                return _project(doc, projection)
+        return None
+
+    async def insert_many(self, docs):
+        for doc in docs:
+            self.docs[doc["_id"]] = dict(doc)
+
+    async def create_index(self, *args, **kwargs):
+        return None
+
+    def watch(self, *args, **kwargs):
+        # Как у одиночного сервера MongoDB: change stream недоступен, main.py переключится на опрос.
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+    async def bulk_write(self, operations, ordered=True):
+        self.bulk_writes += 1
+        for operation in operations:
+            doc_id = operation._filter["_id"]
+            if type(operation).__name__ == 'DeleteOne':
+                self.docs.pop(doc_id, None)
+                continue
+            doc = self.docs.get(doc_id)
+            if doc is None:
+                if not operation._upsert:
+                    continue
+                doc = self.docs[doc_id] = {"_id": doc_id}
+            update = operation._doc
+            doc.update(update.get("$set", {}))
+            for key, value in update.get("$inc", {}).items():
+                doc[key] = doc.get(key, 0) + value
+            for key, value in update.get("$max", {}).items():
+                doc[key] = max(doc.get(key, value), value)
+
+
+class MemoryDatabase:
+    def __init__(self):
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection()
+        return self._collections[name]
+
+
+class MemoryClient:
+    """Замена AsyncIOMotorClient: все базы данных хранятся в памяти процесса."""
+    databases = {} # Общие для всех клиентов, как у настоящего сервера.
+
+    def __init__(self, *args, **kwargs):
+        self.admin = self
+
+    async def command(self, name):
+        return {"ok": 1}
+
+    def close(self):
+        pass
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase()
+        return self.databases[name]
+
+
+# --- ПОДДЕЛЬНЫЙ СЕРВЕР TELEGRAM BOT API ---
+
+class FakeBotApi:
+    """
+    Минимальный HTTP-сервер, отвечающий на запросы python-telegram-bot так же, как api.telegram.org.
+    Отправленные ботом сообщения передаются симулируемым пользователям через очереди чатов.
+    """
+
+    def __init__(self):
+        self.inboxes = {} # ID чата -> asyncio.Queue сообщений, отправленных ботом в этот чат.
+        self.requests = 0 # Сколько запросов к Bot API выполнил бот.
+        self.methods = {} # Имя метода -> количество вызовов.
+        self._message_id = 0
+        self._server = None
+        self.port = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def inbox(self, chat_id):
+        if chat_id not in self.inboxes:
+            self.inboxes[chat_id] = asyncio.Queue()
+        return self.inboxes[chat_id]
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True: # Соединение keep-alive: httpx отправляет по нему много запросов подряд.
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                body = await reader.readexactly(length) if length else b''
+                path = request_line.split()[1].decode()
+                method = unquote(path.rsplit('/', 1)[-1])
+                params = dict(parse_qsl(body.decode()))
+                payload = json.dumps({"ok": True, "result": self._call(method, params)}).encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: '
+                             + str(len(payload)).encode() + b'\r\n\r\n' + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _call(self, method, params):
+        self.requests += 1
+        self.methods[method] = self.methods.get(method, 0) + 1
+        method = method.lower()
+        if method == 'getme':
+            return BOT_USER
+        if method in ('sendmessage', 'editmessagetext'):
+            chat_id = int(params['chat_id'])
+            if method == 'sendmessage':
+                self._message_id += 1
+                message_id = self._message_id
+            else:
+                message_id = int(params['message_id'])
+            message = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get('text', ''),
+            }
+            if method == 'sendmessage':
+                reply_markup = json.loads(params['reply_markup']) if 'reply_markup' in params else None
+                self.inbox(chat_id).put_nowait((message, reply_markup))
+            return message
+        return True
+
+
+# --- СИМУЛЯЦИЯ ПОЛЬЗОВАТЕЛЕЙ ---
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class Timings:
+    """Время выполнения обработчиков (в секундах), собранное за прогон."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def wrap(self, name, handler):
+        """Оборачивает асинхронный обработчик замером времени."""
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                self.samples.setdefault(name, []).append(time.perf_counter() - started)
+        return timed
+
+
+def make_user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+async def play_quiz(application, api, user_id, update_ids, answer_latencies, rng):
+    """
+    Один пользователь: отправляет /quiz и отвечает на вопросы, пока викторина не закончится.
+    Возвращает количество отправленных боту обновлений.
+    """
+    user = make_user(user_id)
+    chat = {"id": user_id, "type": "private"}
+    inbox = api.inbox(user_id)
+    await application.update_queue.put(Update.de_json({
+        "update_id": next(update_ids),
+        "message": {
+            "message_id": 1, "date": int(datetime.now(timezone.utc).timestamp()), "chat": chat, "from": user,
+            "text": "/quiz", "entities": [{"type": "bot_command", "offset": 0, "length": 5}],
+        },
+    }, application.bot))
+    answered_at = None
+    updates = 1
+    while True:
+        message, reply_markup = await inbox.get()
+        if answered_at is not None: # Время от нажатия кнопки до получения следующего сообщения.
+            answer_latencies.append(time.perf_counter() - answered_at)
+            answered_at = None
+        if reply_markup is None: # Сообщение без кнопок - итог викторины.
+            if message["text"].startswith("Викторина завершена"):
+                return updates
+            continue
+        buttons = [row[0] for row in reply_markup["inline_keyboard"]]
+        answered_at = time.perf_counter()
+        updates += 1
+        await application.update_queue.put(Update.de_json({
+            "update_id": next(update_ids),
+            "callback_query": {
+                "id": str(next(update_ids)), "from": user, "chat_instance": str(user_id),
+                "message": message, "data": rng.choice(buttons)["callback_data"],
+            },
+        }, application.bot))
+
+
+def measure_session_memory(count, bank_size):
+    """Возвращает средний объем памяти (в байтах) на одну сессию в SessionStore."""
+    bank = main.QuestionBank.from_questions([main.prepare_question(q) for q in make_questions(bank_size)])
+    store = main.SessionStore()
+    rng = random.Random(0)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for user_id in range(count):
+        store.start(user_id, main.QuizSession(bank, bank.sample({}, main.QUIZ_LENGTH, rng)))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return size / count
+
+
+def measure_question_reads(bank_size, path):
+    """
+    Возвращает среднее время чтения вопроса (в секундах): из банка в памяти, из снимка при промахе кэша
+    декодированных вопросов и из снимка при попадании в кэш. path - файл для снимка.
+    """
+    bank = main.QuestionBank.from_questions([main.prepare_question(q) for q in make_questions(bank_size)])
+    main.write_question_snapshot(bank, path)
+    snapshot = main.load_question_snapshot(path)
+    positions = random.Random(0).sample(range(bank_size), min(bank_size, 1000))
+
+    def timed(read):
+        started = time.perf_counter()
+        for position in positions:
+            read(position)
+        return (time.perf_counter() - started) / len(positions)
+
+    return timed(bank.question), timed(snapshot.question), timed(snapshot.question) # Второй проход - из кэша.
+
+
+class UnavailableCollection(MemoryCollection):
+    """Коллекция, запись в которую не удается (MongoDB недоступна)."""
+
+    async def bulk_write(self, operations, ordered=True):
+        raise ConnectionFailure("MongoDB недоступна")
+
+
+async def measure_session_bound(count, limit, collection=None):
+    """
+    Запускает count викторин при SESSIONS_MAX_ACTIVE = limit (половина из них завершается) и возвращает наибольшее
+    число сессий, которые SessionStore удерживал в памяти. collection=None - без MongoDB. Сброс вызывается
+    после каждых limit викторин, как если бы за интервал сброса начиналось limit викторин.
+    """
+    bank = main.QuestionBank.from_questions([main.prepare_question(q) for q in make_questions(main.QUIZ_LENGTH)])
+    limit, main.SESSIONS_MAX_ACTIVE = main.SESSIONS_MAX_ACTIVE, limit
+    level = main.logger.level
+    main.logger.setLevel(main.logging.CRITICAL) # Ошибки записи здесь ожидаемы.
+    try:
+        store = main.SessionStore()
+        if collection is not None:
+            store.attach(collection)
+        held = 0
+        for user_id in range(count):
+            store.start(user_id, main.QuizSession(bank, array('I', range(main.QUIZ_LENGTH))))
+            if user_id % 2:
+                store.finish(user_id)
+            if user_id % main.SESSIONS_MAX_ACTIVE == 0:
+                await store.flush()
+            sessions = {id(session) for session in (*store._sessions.values(), *store._dirty.values()) if session is not None}
+            held = max(held, len(sessions))
+        return held
+    finally:
+        main.SESSIONS_MAX_ACTIVE = limit
+        main.logger.setLevel(level)
+
+
+def make_questions(count):
+    return [{
+        "_id": i,
+        "question": f"Вопрос {i}: в каком году произошло событие?",
+        "options": ["1905", "1917", "1922", "1914"],
+        "correct_answer": "1917",
+        "correct_index": 1,
+    } for i in range(count)]
+
+
+async def run_benchmark(args):
+    # Лимиты Telegram в тесте не нужны: измеряется сам бот, а не ограничитель частоты.
+    if not args.rate_limits:
+        main.OUTBOUND_GLOBAL_RATE = main.OUTBOUND_CHAT_RATE = main.OUTBOUND_CHAT_BURST = 1_000_000
+    main.QUIZ_LENGTH = args.quiz_length
+    # В одном процессе снимок на диске не нужен: вопросы берутся из коллекции в памяти. В режиме нескольких
+    # процессов обработчики читают вопросы из снимка, как в рабочем режиме.
+    snapshot_directory = tempfile.TemporaryDirectory() if args.workers > 1 else None
+    main.QUESTIONS_SNAPSHOT_PATH = os.path.join(snapshot_directory.name, 'questions.snapshot') if snapshot_directory else None
+    main.outbound = main.OutboundDispatcher()
+    main.session_store = main.SessionStore()
+    main.AsyncIOMotorClient = MemoryClient
+    await MemoryClient()[main.DATABASE_NAME][main.QUESTIONS_COLLECTION_NAME].insert_many(make_questions(args.questions))
+
+    timings = Timings()
+    for name in ('quiz', 'send_question', 'check_answer'):
+        setattr(main, name, timings.wrap(name, getattr(main, name)))
+
+    api = FakeBotApi()
+    await api.start()
+    base_url = f"http://127.0.0.1:{api.port}/bot"
+    if args.workers > 1:
+        # Обновления идут через приложение основного процесса в процессы-обработчики, как в main.main().
+        main.WORKER_PROCESSES = args.workers
+        bot_data = await main.preload_question_bank()
+        application = main.build_ingress_application(*main.start_workers(bot_data, BENCHMARK_TOKEN, base_url),
+                                                     BENCHMARK_TOKEN, base_url)
+        await application.initialize()
+    else:
+        application = main.build_application(BENCHMARK_TOKEN, base_url=base_url)
+        await application.initialize()
+        await main.post_init_setup(application)
+        while 'questions_loaded_at' not in application.bot_data: # Вопросы загружаются в фоне.
+            await asyncio.sleep(0.01)
+    await application.start()
+
+    rng = random.Random(args.seed)
+    update_ids = iter(range(1, 10 ** 12))
+    answer_latencies = []
+    started = time.perf_counter()
+    sent = await asyncio.gather(*(play_quiz(application, api, user_id, update_ids, answer_latencies, rng)
+                           for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+
+    await application.stop()
+    if args.workers > 1:
+        await main.stop_workers(application)
+    else:
+        await main.post_shutdown_cleanup(application)
+    await application.shutdown()
+    await api.stop()
+    if snapshot_directory is not None:
+        reads = measure_question_reads(args.questions, os.path.join(snapshot_directory.name, 'reads.snapshot'))
+        snapshot_directory.cleanup()
+
+    updates = sum(sent)
+    print(f"Пользователей: {args.users}, вопросов в банке: {args.questions}, "
+          f"в викторине: {min(args.quiz_length, args.questions)}, время: {elapsed:.2f} с")
+    print(f"Обновлений: {updates} ({updates / elapsed:.0f}/с), запросов к Bot API: {api.requests} ({api.requests / elapsed:.0f}/с)")
+    if args.workers > 1: # Обработчики выполнялись в других процессах; их время здесь не собрано.
+        print(f"Процессов-обработчиков: {args.workers}")
+        print(f"Чтение вопроса, мкс: из банка в памяти {reads[0] * 1e6:.1f}, из снимка: промах кэша {reads[1] * 1e6:.1f}, "
+              f"попадание {reads[2] * 1e6:.1f} (кэш: {main.QUESTIONS_SNAPSHOT_CACHE_SIZE} вопросов)")
+    print("Время обработчиков, мс:      p50      p95      p99      max")
+    for name, samples in sorted(timings.samples.items()):
+        samples.sort()
+        print(f"  {name:<22} {percentile(samples, 0.5) * 1000:8.3f} {percentile(samples, 0.95) * 1000:8.3f} "
+              f"{percentile(samples, 0.99) * 1000:8.3f} {samples[-1] * 1000:8.3f}")
+    answer_latencies.sort()
+    print(f"  {'ответ -> след. вопрос':<22} {percentile(answer_latencies, 0.5) * 1000:8.3f} "
+          f"{percentile(answer_latencies, 0.95) * 1000:8.3f} {percentile(answer_latencies, 0.99) * 1000:8.3f} "
+          f"{answer_latencies[-1] * 1000:8.3f}")
+    print(f"Память на одну сессию: {measure_session_memory(args.session_sample, args.questions):.0f} байт "
+          f"(замер на {args.session_sample} сессиях)")
+    # Без MongoDB и при ошибках записи сессии не должны копиться сверх ограничения SESSIONS_MAX_ACTIVE
+    # (плюс начатые за один интервал сброса).
+    for name, collection in (("без MongoDB", None), ("MongoDB недоступна", UnavailableCollection())):
+        held = await measure_session_bound(20 * args.session_limit, args.session_limit, collection)
+        print(f"Сессий в памяти ({name}): не больше {held} при ограничении {args.session_limit}")
+        if held > 2 * args.session_limit:
+            raise SystemExit(f"Число сессий в памяти ({name}) не ограничено SESSIONS_MAX_ACTIVE.")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с поддельным Bot API и MongoDB в памяти.")
+    parser.add_argument('--users', type=int, default=200, help="Количество одновременных пользователей.")
+    parser.add_argument('--questions', type=int, default=20, help="Количество вопросов в банке.")
+    parser.add_argument('--quiz-length', type=int, default=20, help="Количество вопросов в одной викторине.")
+    parser.add_argument('--seed', type=int, default=1, help="Зерно генератора случайных ответов.")
+    parser.add_argument('--session-sample', type=int, default=10_000, help="Сколько сессий создать для замера памяти.")
+    parser.add_argument('--session-limit', type=int, default=1000, help="SESSIONS_MAX_ACTIVE для проверки ограничения числа сессий.")
+    parser.add_argument('--workers', type=int, default=1, help="Количество процессов-обработчиков (режим нескольких процессов).")
+    parser.add_argument('--rate-limits', action='store_true', help="Не отключать лимиты отправки сообщений Telegram.")
+    parser.add_argument('--verbose', action='store_true', help="Выводить логи бота уровня INFO.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if not arguments.verbose:
+        main.LOG_LEVEL = main.logging.WARNING # Уровень для процессов-обработчиков, которые настраивают логи заново.
+        main.logging.getLogger().setLevel(main.LOG_LEVEL)
+    asyncio.run(run_benchmark(arguments))
@@ -1,10 +1,35 @@
 # Импорт необходимых библиотек
 import logging # Для логирования событий и ошибок
+import logging.handlers # QueueHandler/QueueListener: запись логов в отдельном потоке
+import queue # Очередь записей лога между event loop и потоком записи
+import random # Выборочное логирование частых событий
+import atexit # Дописываем оставшиеся записи лога при завершении процесса
+import gc # Заморозка объектов основного процесса перед запуском процессов-обработчиков
+import hashlib # Хеши ID вопросов в файле снимка банка вопросов
+import mmap # Отображение файла снимка банка вопросов в память
+import multiprocessing # Процессы-обработчики обновлений в режиме нескольких процессов
+import os # Атомарная замена файла снимка банка вопросов
+import signal # Процессы-обработчики не прерываются по Ctrl+C сами, их останавливает основной процесс
+import bson # Кодирование вопросов в файле снимка (входит в состав pymongo)
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup # Основные классы для взаимодействия с Telegram API
-from telegram.ext import Application, ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes # Классы для создания и управления ботом
+from telegram.ext import Application, ApplicationBuilder, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes, TypeHandler # Классы для создания и управления ботом
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError # Исключения, которые может вернуть Telegram Bot API
+from telegram.helpers import escape_markdown # Экранирование текста при объединении сообщений с разметкой Markdown
 from motor.motor_asyncio import AsyncIOMotorClient # Асинхронный драйвер для MongoDB
+from pymongo import UpdateOne, DeleteOne # Операции для пакетной записи (bulk_write) в MongoDB
 from pymongo.errors import ConnectionFailure, OperationFailure # Исключения для обработки ошибок MongoDB
 import asyncio # Библиотека для асинхронного программирования
+import bisect # Поиск корзины гистограммы по значению
+import functools # Сохранение имени и документации обработчиков при обертывании замером времени
+import struct # Заголовок файла снимка банка вопросов
+import sys # Снимки стеков потоков для профилировщика
+import threading # Поток сэмплирующего профилировщика
+import time # Монотонные часы для учета простоя сессий
+import zlib # Контрольные суммы: короткая - ID вопроса для callback_data кнопок, CRC32 - файла снимка банка вопросов
+from array import array # Компактные массивы позиций вопросов (4 байта на вопрос) для индекса и сессий
+from collections import OrderedDict, deque # Упорядоченный словарь для вытеснения сессий (LRU) и очереди исходящих сообщений
+from collections.abc import Mapping # Словарь позиций вопросов снимка, который читается прямо из файла
+from datetime import datetime, timedelta, timezone # Метки времени для опроса изменений в коллекции вопросов
 
 # --- КОНФИГУРАЦИЯ БОТА ---
 # Эти параметры определяют, как бот будет подключаться к Telegram и MongoDB.
@@ -13,26 +38,319 @@ MONGO_URI = 'mongodb://localhost:27017/'  # Адрес сервера MongoDB. '
 DATABASE_NAME = 'history_quiz_db' # Имя базы данных в MongoDB, где хранятся вопросы.
 QUESTIONS_COLLECTION_NAME = 'questions' # Имя коллекции внутри базы данных для документов с вопросами.
 
+# Способ получения обновлений от Telegram.
+# Поллинг (USE_WEBHOOK = False) не требует настройки сервера. В режиме webhook Telegram сам присылает обновления
+# на WEBHOOK_URL, а бот принимает их локальным HTTP-сервером на WEBHOOK_LISTEN:WEBHOOK_PORT
+# (обычно за reverse proxy с HTTPS). Для webhook нужна установка python-telegram-bot[webhooks].
+USE_WEBHOOK = False
+WEBHOOK_LISTEN = '127.0.0.1' # Адрес локального HTTP-сервера.
+WEBHOOK_PORT = 8443 # Порт локального HTTP-сервера.
+WEBHOOK_PATH = 'telegram' # Путь, по которому сервер принимает обновления.
+WEBHOOK_URL = '' # Публичный HTTPS-адрес, который сообщается Telegram, например 'https://example.com/telegram'.
+WEBHOOK_SECRET_TOKEN = None # Секрет, по которому сервер отличает запросы Telegram от посторонних (необязательно).
+CONCURRENT_UPDATES = 64 # Сколько обновлений обрабатываются одновременно (обновления одного пользователя - всегда по очереди).
+# Режим нескольких процессов: при WORKER_PROCESSES > 1 основной процесс только получает обновления (поллингом
+# или через webhook) и передает каждое в процесс-обработчик, выбранный по ID пользователя, поэтому викторина
+# одного пользователя всегда обрабатывается одним процессом. Банк вопросов загружается до запуска обработчиков,
+# и они получают его общим (copy-on-write после fork) вместо отдельной копии в каждом процессе. Только для Linux/macOS.
+WORKER_PROCESSES = 1
+WORKER_QUEUE_SIZE = 10_000 # Максимум обновлений, ожидающих в очереди одного процесса-обработчика.
+WORKER_SHUTDOWN_TIMEOUT = 10 # Сколько секунд ждать завершения процесса-обработчика при остановке бота.
+# Бот обрабатывает только команды (/start, /quiz) и нажатия inline-кнопок; остальные типы обновлений не запрашиваем.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# HTTP-эндпоинт с метриками в формате Prometheus (GET /metrics). None - эндпоинт выключен.
+METRICS_LISTEN = '127.0.0.1' # Адрес, на котором слушает эндпоинт метрик.
+METRICS_PORT = None # Порт эндпоинта метрик, например 9100.
+# Сэмплирующий профилировщик: GET /debug/profile?seconds=N возвращает стеки event loop за N секунд
+# в "свернутом" формате (для flamegraph.pl / speedscope). Выключен по умолчанию.
+PROFILER_ENABLED = False
+PROFILER_INTERVAL = 0.005 # Период (в секундах) между снимками стека.
+QUESTIONS_REFRESH_INTERVAL = 5 # Период (в секундах), с которым изменения в коллекции вопросов применяются к банку в памяти.
+QUESTIONS_REFRESH_MAX_BATCH = 500 # Максимум изменений, накапливаемых перед применением к банку вопросов.
+QUESTIONS_REFRESH_RETRY_DELAY = 30 # Пауза (в секундах) перед повторной попыткой следить за изменениями после ошибки.
+# Локальный снимок банка вопросов: при запуске бот сразу отвечает по нему, а вопросы из MongoDB загружаются в фоне.
+QUESTIONS_SNAPSHOT_PATH = 'questions.snapshot' # Путь к файлу снимка; None - снимок не используется.
+# Сколько вопросов из снимка держать декодированными в памяти процесса (~3 КБ на вопрос); None - все вопросы банка.
+# Чтение вопроса, которого нет в кэше, стоит ~50 мкс (в основном сборка клавиатуры), из кэша - меньше 1 мкс.
+QUESTIONS_SNAPSHOT_CACHE_SIZE = 10_000
+MONGO_RETRY_INITIAL_DELAY = 1 # Пауза (в секундах) перед первой повторной попыткой подключиться к MongoDB.
+MONGO_RETRY_MAX_DELAY = 60 # Максимальная пауза между попытками; после каждой неудачи пауза удваивается.
+SESSIONS_COLLECTION_NAME = 'sessions' # Имя коллекции для сохранения незавершенных викторин пользователей.
+SESSIONS_FLUSH_INTERVAL = 2 # Период (в секундах), с которым накопленные изменения сессий одной пачкой записываются в MongoDB.
+SESSIONS_IDLE_TTL = 30 * 60 # Время простоя (в секундах), после которого брошенная викторина считается истекшей.
+SESSIONS_MAX_ACTIVE = 100_000 # Максимум сессий в памяти; при превышении вытесняются самые давно неактивные.
+# Статистика: ответы на каждый вопрос и результаты пользователей копятся в памяти и записываются в MongoDB пачками.
+STATS_QUESTIONS_COLLECTION_NAME = 'question_stats' # Число ответов и правильных ответов на каждый вопрос.
+STATS_USERS_COLLECTION_NAME = 'user_stats' # Пройденные викторины и лучший результат каждого пользователя.
+STATS_FLUSH_INTERVAL = 10 # Период (в секундах), с которым накопленные счетчики записываются в MongoDB.
+LEADERBOARD_SIZE = 10 # Сколько лучших игроков показывает команда /top.
+
+# Ограничения Telegram на отправку сообщений (https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this).
+OUTBOUND_GLOBAL_RATE = 30 # Сообщений в секунду на весь бот.
+OUTBOUND_CHAT_RATE = 1 # Сообщений в секунду в один чат (в среднем).
+OUTBOUND_CHAT_BURST = 3 # Сколько сообщений подряд можно отправить в один чат без ожидания.
+OUTBOUND_WORKERS = 8 # Количество параллельных задач, выполняющих запросы к Telegram.
+OUTBOUND_MAX_RETRIES = 3 # Сколько раз повторять запрос после сетевой ошибки.
+
 # Включаем и настраиваем систему логирования.
 # Логи помогают отслеживать работу бота, выявлять ошибки и понимать последовательность событий.
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', # Формат записи лога: время, имя логгера, уровень (INFO, ERROR и т.д.), сообщение.
-    level=logging.INFO # Устанавливаем уровень логирования. INFO означает, что будут записываться информационные сообщения, предупреждения и ошибки.
-)
+# Обработчики бота не пишут в stderr сами: запись лога только кладется в очередь (без форматирования),
+# а форматирует и выводит её отдельный поток QueueListener. Так медленный вывод не останавливает event loop.
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s' # Формат записи лога: время, имя логгера, уровень (INFO, ERROR и т.д.), сообщение.
+LOG_LEVEL = logging.INFO # Уровень логирования. INFO означает, что будут записываться информационные сообщения, предупреждения и ошибки.
+LOG_QUEUE_SIZE = 10_000 # Максимум записей, ожидающих вывода; при переполнении новые записи отбрасываются.
+# Уровень и доля записей, попадающих в лог, для частых событий викторины.
+# Например, (logging.INFO, 0.01) - в лог попадает примерно каждое сотое событие.
+LOG_EVENTS = {
+    "quiz_started": (logging.INFO, 1.0), # Пользователь начал викторину.
+    "question_sent": (logging.DEBUG, 1.0), # Вопрос поставлен в очередь отправки.
+    "answer": (logging.INFO, 0.01), # Пользователь ответил на вопрос.
+    "quiz_completed": (logging.INFO, 1.0), # Викторина завершена.
+}
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладет записи лога в ограниченную очередь и никогда не ждет: если очередь заполнена
+    (поток вывода не успевает), запись отбрасывается и учитывается в счетчике dropped.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0 # Сколько записей отброшено из-за переполнения очереди.
+
+    def prepare(self, record):
+        # Стандартный QueueHandler форматирует сообщение в вызывающем потоке. Запись остается в этом же процессе,
+        # поэтому форматирование откладываем до потока вывода.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging():
+    """Настраивает вывод логов через очередь и фоновый поток. Возвращает обработчик очереди."""
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop) # При выходе listener выводит записи, оставшиеся в очереди.
+    queue_handler.listener = listener # Процессы, завершающиеся без atexit (multiprocessing), останавливают его сами.
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+    # httpx пишет строку INFO на каждый запрос к Telegram; оставляем от него только предупреждения и ошибки.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    return queue_handler
+
+
+log_handler = configure_logging()
 logger = logging.getLogger(__name__) # Создаем экземпляр логгера для текущего модуля.
 
+
+def log_event(event, msg, *args):
+    """
+    Логирует частое событие викторины с уровнем и долей выборки из LOG_EVENTS.
+    Аргументы подставляются в msg (%-форматирование) только если запись действительно попадет в лог.
+    """
+    level, sample_rate = LOG_EVENTS[event]
+    if not logger.isEnabledFor(level):
+        return
+    if sample_rate < 1 and random.random() >= sample_rate:
+        return
+    logger.log(level, msg, *args)
+
+# --- МЕТРИКИ ---
+
+class Counter:
+    """Монотонно растущий счетчик. Значения хранятся отдельно для каждого значения метки (label)."""
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label # Имя метки, например 'result'; None - метрика без меток.
+        self.values = {}
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_value, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.label, label_value)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Гистограмма длительностей (в секундах) с фиксированными корзинами, как в клиенте Prometheus.
+    observe() стоит O(log числа корзин) и не выделяет память после первого наблюдения для метки.
+    """
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_text, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {} # Значение метки -> [счетчики корзин..., счетчик сверх последней корзины, сумма, количество].
+
+    def observe(self, value, label_value=None):
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = [0] * (len(self.buckets) + 3)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                labels = _format_labels(self.label, label_value, le=bound)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label, label_value)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label, label_value)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """
+    Значение, которое вычисляется функцией в момент запроса метрик.
+    kind='counter' - для счетчиков, которые ведет другой объект (например, SessionStore).
+    """
+
+    def __init__(self, name, help_text, function, kind="gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self.kind = kind
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}", f"{self.name} {self.function()}"]
+
+
+def _format_labels(label, label_value, le=None):
+    """Форматирует метки метрики: {label="value",le="0.5"}."""
+    pairs = []
+    if label is not None and label_value is not None:
+        pairs.append(f'{label}="{label_value}"')
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class MetricsRegistry:
+    """Набор метрик бота и их вывод в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help_text, label=None):
+        return self.metrics.setdefault(name, Counter(name, help_text, label))
+
+    def histogram(self, name, help_text, label=None):
+        return self.metrics.setdefault(name, Histogram(name, help_text, label))
+
+    def gauge(self, name, help_text, function, kind="gauge"):
+        self.metrics[name] = Gauge(name, help_text, function, kind) # Функция заменяется, например, при повторном запуске.
+        return self.metrics[name]
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry() # Все метрики бота.
+handler_latency = metrics.histogram("histeye_handler_latency_seconds", "Время выполнения обработчиков обновлений.", "handler")
+handler_errors = metrics.counter("histeye_handler_errors_total", "Исключения в обработчиках обновлений.", "handler")
+telegram_latency = metrics.histogram("histeye_telegram_request_seconds", "Время запросов к Telegram Bot API.", "method")
+telegram_errors = metrics.counter("histeye_telegram_errors_total", "Ошибки запросов к Telegram Bot API.", "error")
+mongo_latency = metrics.histogram("histeye_mongo_request_seconds", "Время запросов к MongoDB.", "operation")
+answers_total = metrics.counter("histeye_answers_total", "Ответы на вопросы викторины.", "result")
+edit_fallbacks_total = metrics.counter("histeye_edit_fallbacks_total", "Результаты ответа, отправленные новым сообщением, потому что сообщение не удалось отредактировать.")
+quizzes_total = metrics.counter("histeye_quizzes_total", "Начатые и завершенные викторины.", "event")
+
+
+def instrumented(name):
+    """Декоратор: замеряет время выполнения асинхронного обработчика и считает исключения в нем."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                handler_errors.inc(name)
+                raise
+            finally:
+                handler_latency.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+
+def sample_stacks(thread_id, seconds):
+    """
+    Сэмплирующий профилировщик: в течение seconds секунд с периодом PROFILER_INTERVAL снимает стек
+    потока thread_id и возвращает количество попаданий каждого стека в "свернутом" формате
+    ("модуль:функция;модуль:функция N"). Выполняется в отдельном потоке и не останавливает event loop.
+    """
+    counts = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(f"{frame.f_code.co_filename.rsplit('/', 1)[-1]}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        if stack:
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(PROFILER_INTERVAL)
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+
+
+async def handle_metrics_request(reader, writer):
+    """Отвечает на HTTP-запросы к эндпоинту метрик: GET /metrics и (если включено) GET /debug/profile?seconds=N."""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""): # Заголовки запроса не нужны.
+            pass
+        parts = request_line.decode("latin-1").split()
+        path, _, query = (parts[1] if len(parts) > 1 else "/").partition("?")
+        status, body = "404 Not Found", "not found\n"
+        if path == "/metrics":
+            status, body = "200 OK", metrics.render()
+        elif path == "/debug/profile" and PROFILER_ENABLED:
+            params = dict(pair.partition("=")[::2] for pair in query.split("&") if pair)
+            seconds = min(float(params.get("seconds", 10)), 60)
+            body = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds)
+            status = "200 OK"
+        payload = body.encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+    except Exception as e:
+        logger.warning("Ошибка при обработке запроса к эндпоинту метрик: %s", e)
+    finally:
+        writer.close()
+
+
 # --- ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ДЛЯ MONGODB ---
 # Эти переменные будут хранить объекты для работы с MongoDB после успешного подключения.
 mongo_client = None # Клиент для подключения к серверу MongoDB.
 db = None # Объект базы данных.
 questions_collection = None # Объект коллекции вопросов.
 
-# --- СОСТОЯНИЕ ПОЛЬЗОВАТЕЛЕЙ ---
-# Словарь для хранения текущего состояния викторины для каждого пользователя.
-# Ключ - ID пользователя, значение - словарь с его счетом и номером текущего вопроса.
-# Это простое хранилище в памяти; при перезапуске бота данные из user_state будут потеряны.
-user_state = {}
-
 
 # --- ФУНКЦИИ ДЛЯ РАБОТЫ С БАЗОЙ ДАННЫХ (АСИНХРОННЫЕ) ---
 
@@ -48,105 +366,1452 @@ async def connect_to_mongodb():
         mongo_client = AsyncIOMotorClient(MONGO_URI)
         # Проверяем соединение, отправив команду 'ping' на сервер.
         # 'await' приостанавливает выполнение функции до получения ответа от сервера.
+        started = time.perf_counter()
         await mongo_client.admin.command('ping')
+        mongo_latency.observe(time.perf_counter() - started, "ping")
         # Если 'ping' успешен, получаем доступ к нашей базе данных и коллекции.
         db = mongo_client[DATABASE_NAME]
         questions_collection = db[QUESTIONS_COLLECTION_NAME]
-        logger.info(f"Успешно подключено к MongoDB (асинхронно) - база данных: {DATABASE_NAME}, коллекция: {QUESTIONS_COLLECTION_NAME}, хост: {MONGO_URI}.")
+        session_store.attach(db[SESSIONS_COLLECTION_NAME]) # Сессии викторин начинают сохраняться в MongoDB.
+        stats.attach(db[STATS_QUESTIONS_COLLECTION_NAME], db[STATS_USERS_COLLECTION_NAME])
+        logger.info("Успешно подключено к MongoDB (асинхронно) - база данных: %s, коллекция: %s, хост: %s.", DATABASE_NAME, QUESTIONS_COLLECTION_NAME, MONGO_URI)
         return True
     except ConnectionFailure as e: # Ошибка: не удалось подключиться к серверу.
-        logger.error(f"Не удалось подключиться к MongoDB (асинхронно): {e}. Убедитесь, что сервер запущен.")
+        logger.error("Не удалось подключиться к MongoDB (асинхронно): %s. Убедитесь, что сервер запущен.", e)
         return False
     except OperationFailure as e: # Ошибка: проблема с операцией, часто связана с аутентификацией.
-        logger.error(f"Ошибка аутентификации MongoDB (асинхронно): {e}")
+        logger.error("Ошибка аутентификации MongoDB (асинхронно): %s", e)
         return False
     except Exception as e: # Любая другая непредвиденная ошибка.
-        logger.error(f"Неизвестная ошибка при подключении к MongoDB (асинхронно): {e}")
+        logger.error("Неизвестная ошибка при подключении к MongoDB (асинхронно): %s", e)
         return False
 
 
+# Поля документа вопроса, которые реально используются ботом.
+# Проекция в find() отсекает всё остальное (комментарии редакторов, служебные поля и т.п.),
+# поэтому по сети и в память приходит только то, что нужно для викторины.
+# Необязательные поля вопроса, по которым можно выбрать вопросы для викторины (/quiz category=... difficulty=... era=...).
+QUESTION_FILTER_FIELDS = ("category", "difficulty", "era")
+QUESTION_PROJECTION = {"question": 1, "options": 1, "correct_answer": 1, "correct_index": 1, **{field: 1 for field in QUESTION_FILTER_FIELDS}}
+QUIZ_LENGTH = 10 # Сколько вопросов в одной викторине.
+QUIZ_SAMPLE_SCAN_LIMIT = 500 # Кандидатов не больше этого числа перебираются целиком; из большего числа вопросы выбираются случайными пробами.
+QUESTIONS_BATCH_SIZE = 1000 # Сколько документов курсор забирает с сервера за один запрос и сколько валидируется за один раз.
+MAX_LOGGED_REJECTED = 10 # Сколько некорректных документов логируем подробно; об остальных сообщаем только итоговым счетчиком.
+
+# Неизменяемые части ответов, общие для всех вопросов. Создаются один раз при запуске.
+CORRECT_ANSWER_SUFFIX = "✅ Правильно!" # Результат правильного ответа.
+EMPTY_REPLY_MARKUP = InlineKeyboardMarkup([]) # Пустая клавиатура, чтобы убрать кнопки после ответа.
+
+
+def prepare_question(question):
+    """
+    Заранее готовит всё, что нужно для отправки вопроса и показа результата, и сохраняет рядом с вопросом:
+    - answer_token: метка вопроса в callback_data кнопок;
+    - reply_markup: inline-клавиатура с вариантами ответов;
+    - incorrect_suffix: текст результата неправильного ответа с правильным вариантом.
+    Эти данные зависят только от самого вопроса, поэтому при каждой отправке их не нужно создавать заново.
+    Объекты Telegram неизменяемы, так что одну клавиатуру можно безопасно отправлять всем пользователям.
+    """
+    # answer_token - короткая метка вопроса (контрольная сумма его ID). По ней check_answer отличает
+    # нажатие кнопки текущего вопроса от повторного нажатия кнопки уже отвеченного.
+    question["answer_token"] = format(zlib.crc32(str(question["_id"]).encode()), '08x')
+    # Каждая кнопка содержит текст варианта и callback_data ("метка:индекс варианта").
+    # callback_data будет отправлена боту при нажатии на кнопку.
+    question["reply_markup"] = InlineKeyboardMarkup(
+        [[InlineKeyboardButton(option_text, callback_data=f"{question['answer_token']}:{i}")]
+         for i, option_text in enumerate(question["options"])]
+    )
+    # Markdown используется для выделения правильного ответа (*текст* -> курсив).
+    question["incorrect_suffix"] = f"❌ Неправильно. Правильный ответ: *{question['correct_answer']}*."
+    return question
+
+
+def validate_question(q_doc):
+    """
+    Проверяет один документ вопроса из MongoDB.
+    Возвращает кортеж (вопрос, причины): вопрос - очищенный словарь с заранее подготовленными
+    клавиатурой и текстами ответа (или None, если документ некорректен),
+    причины - список сообщений об ошибках валидации.
+    Функция не обращается к event loop, поэтому её можно вызывать из рабочего потока.
+    """
+    # Извлекаем поля из документа, используя .get() для безопасного доступа (вернет None, если поля нет).
+    question_text = q_doc.get("question")
+    options = q_doc.get("options")
+    correct_answer = q_doc.get("correct_answer")
+    correct_index = q_doc.get("correct_index")
+
+    reasons = [] # Список для сообщений об ошибках валидации.
+
+    # Валидация: текст вопроса должен быть непустой строкой.
+    if not isinstance(question_text, str) or not question_text.strip():
+        reasons.append(f"'question' отсутствует, не строка или пустое: {question_text!r} (тип: {type(question_text)})")
+
+    # Валидация: варианты ответов должны быть непустым списком строк.
+    if not isinstance(options, list):
+        reasons.append(f"'options' не является списком (тип: {type(options)})")
+    elif not options:
+        reasons.append("'options' является пустым списком")
+    elif not all(isinstance(opt, str) for opt in options): # Проверяем, что все элементы списка - строки.
+        reasons.append("некоторые элементы в 'options' не являются строками")
+
+    # Валидация: текст правильного ответа должен быть непустой строкой.
+    if not isinstance(correct_answer, str) or not correct_answer.strip():
+        reasons.append(f"'correct_answer' отсутствует, не строка или пустое: {correct_answer!r} (тип: {type(correct_answer)})")
+
+    # Валидация: индекс правильного ответа должен быть целым числом.
+    # Допускается, если пришло число с плавающей точкой, но оно целое (например, 2.0).
+    if not isinstance(correct_index, int):
+        if isinstance(correct_index, float) and correct_index.is_integer():
+            correct_index = int(correct_index) # Преобразуем в int.
+        else:
+            reasons.append(f"'correct_index' не является целым числом: {correct_index!r} (тип: {type(correct_index)})")
+
+    if reasons:
+        return None, reasons
+
+    # Собираем новый словарь только из нужных полей.
+    # _id сохраняется: по нему обновления из коллекции сопоставляются с вопросами в памяти.
+    question = {
+        "_id": q_doc.get("_id"),
+        "question": question_text,
+        "options": options,
+        "correct_answer": correct_answer,
+        "correct_index": correct_index,
+    }
+    # Поля для выбора вопросов необязательны; значения приводятся к одному виду, чтобы "Революции" и "революции" совпадали.
+    for field in QUESTION_FILTER_FIELDS:
+        value = normalize_filter_value(q_doc.get(field))
+        if value is not None:
+            question[field] = value
+    return prepare_question(question), reasons
+
+
+def normalize_filter_value(value):
+    """Приводит значение поля выбора (category, difficulty, era) к строке в нижнем регистре; None - поле не задано."""
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        return None
+    value = str(value).strip().lower()
+    return value or None
+
+
+def validate_questions_batch(q_docs):
+    """
+    Валидирует пачку документов. Выполняется в рабочем потоке через asyncio.to_thread,
+    чтобы проверка большого банка вопросов не останавливала event loop.
+    Возвращает кортеж (корректные вопросы, список (ID, причины) для отклоненных документов).
+    """
+    valid = []
+    rejected = []
+    for q_doc in q_docs:
+        question, reasons = validate_question(q_doc)
+        if question is not None:
+            valid.append(question)
+        else:
+            rejected.append((q_doc.get('_id', 'N/A'), reasons))
+    return valid, rejected
+
+
 async def load_questions_from_db():
     """
     Асинхронно загружает все вопросы из коллекции 'questions' в MongoDB.
-    Проводит валидацию каждого вопроса.
-    Возвращает список корректных вопросов или пустой список в случае ошибки.
+    Документы читаются курсором порциями по QUESTIONS_BATCH_SIZE с проекцией только нужных полей,
+    каждая порция валидируется в рабочем потоке, пока курсор уже забирает следующую.
+    Возвращает список корректных вопросов или None в случае ошибки (в отличие от пустой коллекции).
     """
     if questions_collection is None: # Проверка, что соединение с коллекцией установлено.
         logger.error("Коллекция вопросов MongoDB не инициализирована.")
-        return []
+        return None
     try:
-        # Ищем все документы в коллекции. find() возвращает курсор.
-        # to_list(length=None) асинхронно извлекает все документы из курсора в список.
-        questions_cursor = questions_collection.find()
-        questions = await questions_cursor.to_list(length=None)
-        logger.info(f"Найдено {len(questions)} документов в коллекции '{QUESTIONS_COLLECTION_NAME}'.")
+        # find() возвращает курсор; batch_size определяет размер порции, которую драйвер забирает с сервера за раз.
+        # Документы не собираются в один большой список: в памяти одновременно находятся максимум две порции.
+        questions_cursor = questions_collection.find({}, projection=QUESTION_PROJECTION, batch_size=QUESTIONS_BATCH_SIZE)
+        started = time.perf_counter()
 
         loaded_questions = [] # Список для хранения валидных вопросов.
-        for q_doc in questions: # Обрабатываем каждый документ из базы данных.
-            logger.info(f"Обработка документа из MongoDB: {q_doc}")
-
-            # Извлекаем поля из документа, используя .get() для безопасного доступа (вернет None, если поля нет).
-            question_text = q_doc.get("question")
-            options = q_doc.get("options")
-            correct_answer = q_doc.get("correct_answer")
-            correct_index = q_doc.get("correct_index")
-
-            is_valid = True # Флаг, указывающий, прошел ли вопрос валидацию.
-            reasons = [] # Список для сообщений об ошибках валидации.
-
-            # Валидация: текст вопроса должен быть непустой строкой.
-            if not isinstance(question_text, str) or not question_text.strip():
-                is_valid = False
-                reasons.append(f"'question' отсутствует, не строка или пустое: {question_text} (тип: {type(question_text)})")
-
-            # Валидация: варианты ответов должны быть непустым списком строк.
-            if not isinstance(options, list):
-                is_valid = False
-                reasons.append(f"'options' не является списком: {options} (тип: {type(options)})")
-            elif not options:
-                is_valid = False
-                reasons.append("'options' является пустым списком")
-            else:
-                if not all(isinstance(opt, str) for opt in options): # Проверяем, что все элементы списка - строки.
-                    is_valid = False
-                    reasons.append("некоторые элементы в 'options' не являются строками")
-
-            # Валидация: текст правильного ответа должен быть непустой строкой.
-            if not isinstance(correct_answer, str) or not correct_answer.strip():
-                is_valid = False
-                reasons.append(f"'correct_answer' отсутствует, не строка или пустое: {correct_answer} (тип: {type(correct_answer)})")
-
-            # Валидация: индекс правильного ответа должен быть целым числом.
-            # Допускается, если пришло число с плавающей точкой, но оно целое (например, 2.0).
-            if not isinstance(correct_index, int):
-                if isinstance(correct_index, float) and correct_index.is_integer():
-                    correct_index = int(correct_index) # Преобразуем в int.
-                    q_doc["correct_index"] = correct_index # Обновляем значение в исходном словаре, чтобы сохранить правильный тип.
-                else:
-                    is_valid = False
-                    reasons.append(f"'correct_index' не является целым числом: {correct_index} (тип: {type(correct_index)})")
-
-            if is_valid:
-                if '_id' in q_doc: # MongoDB автоматически добавляет поле _id.
-                    del q_doc['_id'] # Удаляем его, так как оно не используется в логике бота.
-                loaded_questions.append(q_doc) # Добавляем валидный вопрос.
-            else:
-                # Если вопрос не прошел валидацию, логируем предупреждение.
-                logger.warning(f"Пропущен некорректный вопрос (ID: {q_doc.get('_id', 'N/A')}): {' | '.join(reasons)}. Документ: {q_doc}")
+        total_documents = 0 # Сколько документов прочитано из коллекции.
+        rejected_count = 0 # Сколько документов не прошли валидацию.
+        pending_validation = None # Задача валидации предыдущей порции, выполняющаяся в рабочем потоке.
+
+        async def collect(task):
+            """Дожидается валидации порции и учитывает её результат."""
+            nonlocal rejected_count
+            valid, rejected = await task
+            loaded_questions.extend(valid)
+            for doc_id, reasons in rejected:
+                rejected_count += 1
+                if rejected_count <= MAX_LOGGED_REJECTED: # Подробно логируем только первые отклоненные документы.
+                    logger.warning("Пропущен некорректный вопрос (ID: %s): %s", doc_id, ' | '.join(reasons))
+
+        batch = []
+        async for q_doc in questions_cursor:
+            batch.append(q_doc)
+            total_documents += 1
+            if len(batch) >= QUESTIONS_BATCH_SIZE:
+                if pending_validation is not None:
+                    await collect(pending_validation)
+                # Запускаем валидацию порции в отдельном потоке и сразу продолжаем читать курсор.
+                pending_validation = asyncio.ensure_future(asyncio.to_thread(validate_questions_batch, batch))
+                batch = []
 
-        logger.info(f"Загружено {len(loaded_questions)} корректных вопросов после обработки.")
+        if pending_validation is not None:
+            await collect(pending_validation)
+        if batch: # Последняя неполная порция.
+            await collect(asyncio.to_thread(validate_questions_batch, batch))
+
+        mongo_latency.observe(time.perf_counter() - started, "load_questions")
+        logger.info("Найдено %s документов в коллекции '%s'.", total_documents, QUESTIONS_COLLECTION_NAME)
+        if rejected_count:
+            logger.warning("Пропущено %s некорректных документов (подробно показаны первые %s).", rejected_count, min(rejected_count, MAX_LOGGED_REJECTED))
+        logger.info("Загружено %s корректных вопросов после обработки.", len(loaded_questions))
         return loaded_questions
     except OperationFailure as e: # Ошибка операции с MongoDB.
-        logger.error(f"Ошибка операции MongoDB при загрузке вопросов (асинхронно): {e}")
-        return []
+        logger.error("Ошибка операции MongoDB при загрузке вопросов (асинхронно): %s", e)
+        return None
     except Exception as e: # Другие ошибки.
-        logger.error(f"Ошибка при загрузке вопросов из базы данных (асинхронно): {e}")
-        return []
+        logger.error("Ошибка при загрузке вопросов из базы данных (асинхронно): %s", e)
+        return None
+
+
+# --- БАНК ВОПРОСОВ В ПАМЯТИ ---
+
+QUESTION_OVERLAY_SHARDS = 256 # На сколько частей разбиты изменения банка вопросов (см. ShardedMap).
+_UNCHANGED = object() # Признак "ключа нет среди изменений" (None в изменениях означает удаленный вопрос).
+
+
+class ShardedMap:
+    """
+    Неизменяемый словарь, разбитый на QUESTION_OVERLAY_SHARDS частей по хешу ключа.
+    updated() возвращает новый словарь, копируя только кортеж частей и части, в которых меняются ключи,
+    поэтому стоимость пачки изменений не зависит от общего числа ключей, а старый словарь остается прежним.
+    """
+    __slots__ = ("_shards", "_size")
+
+    def __init__(self, shards=None, size=0):
+        self._shards = shards if shards is not None else (None,) * QUESTION_OVERLAY_SHARDS
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def get(self, key, default=None):
+        shard = self._shards[hash(key) % QUESTION_OVERLAY_SHARDS]
+        return default if shard is None else shard.get(key, default)
+
+    def updated(self, items):
+        """Возвращает новый словарь с парами ключ-значение из items."""
+        shards = list(self._shards)
+        copied = set() # Части, уже скопированные для нового словаря.
+        size = self._size
+        for key, value in items:
+            number = hash(key) % QUESTION_OVERLAY_SHARDS
+            if number not in copied:
+                shards[number] = dict(shards[number] or ())
+                copied.add(number)
+            shard = shards[number]
+            if key not in shard:
+                size += 1
+            shard[key] = value
+        return ShardedMap(tuple(shards), size)
+
+
+class QuestionBank:
+    """
+    Неизменяемый снимок банка вопросов.
+    base_questions - исходный список вопросов (list или SnapshotQuestions), base_positions - словарь ID документа ->
+    позиция в нем. Оба никогда не меняются: правки коллекции хранятся отдельно, в changed (позиция -> вопрос,
+    None - вопрос удален) и changed_positions (ID -> позиция, None - вопрос удален). Позиции вопросов не сдвигаются,
+    новые вопросы получают позиции после последней; length - число позиций, size - число действующих вопросов.
+    Вопрос и позицию нужно получать через question() и position(), которые учитывают правки.
+    index - инвертированный индекс: (поле, значение) -> array позиций вопросов с этим значением поля
+    (поля из QUESTION_FILTER_FIELDS). При правке или удалении вопроса его позиция переносится между списками
+    (см. _index_question), поэтому в каждом списке позиция встречается не больше одного раза.
+    Изменения применяются копированием (copy-on-write): apply_changes возвращает новый снимок,
+    а викторины, уже начатые со старым снимком, продолжают работать с ним без изменений.
+    Индекс общий для снимков одного поколения: выбор вопросов всегда идет по последнему снимку,
+    а старые снимки индекс не читают, поэтому более поздние правки списков им не мешают.
+    """
+    __slots__ = ("base_questions", "base_positions", "size", "index", "changed", "changed_positions", "length")
+
+    def __init__(self, base_questions=None, base_positions=None, size=0, index=None, changed=None, changed_positions=None, length=None):
+        self.base_questions = base_questions if base_questions is not None else []
+        self.base_positions = base_positions if base_positions is not None else {}
+        self.size = size
+        self.index = index if index is not None else {}
+        self.changed = changed if changed is not None else ShardedMap()
+        self.changed_positions = changed_positions if changed_positions is not None else ShardedMap()
+        self.length = length if length is not None else len(self.base_questions)
+
+    @classmethod
+    def from_questions(cls, questions):
+        """Создает банк из списка проверенных вопросов и строит индекс по полям выбора."""
+        questions = list(questions)
+        positions = {q["_id"]: i for i, q in enumerate(questions)}
+        index = {}
+        for position, question in enumerate(questions):
+            _index_question(index, position, question)
+        return cls(questions, positions, len(questions), index)
+
+    def __len__(self):
+        return self.size
+
+    def question(self, position):
+        """Возвращает вопрос на позиции position или None, если он удален."""
+        question = self.changed.get(position, _UNCHANGED)
+        return self.base_questions[position] if question is _UNCHANGED else question
+
+    def position(self, doc_id):
+        """Возвращает позицию вопроса с ID doc_id или None, если такого вопроса в банке нет."""
+        position = self.changed_positions.get(doc_id, _UNCHANGED)
+        return self.base_positions.get(doc_id) if position is _UNCHANGED else position
+
+    def iter_questions(self):
+        """Перебирает вопросы по позициям (None на месте удаленных)."""
+        return (self.question(position) for position in range(self.length))
+
+    def apply_changes(self, upserts, deleted_ids):
+        """
+        Возвращает новый снимок с примененными изменениями.
+        upserts - словарь ID -> проверенный вопрос (новый или измененный), deleted_ids - ID удаленных вопросов.
+        Исходный список и словарь позиций не копируются: копируются только части ShardedMap с измененными
+        позициями и ID, поэтому стоимость обработки пропорциональна числу изменений, а не размеру банка.
+        """
+        changed = {} # Позиция -> новый вопрос или None.
+        changed_positions = {} # ID -> позиция или None.
+        size = self.size
+        length = self.length
+        for doc_id in deleted_ids:
+            position = self.position(doc_id)
+            if position is not None and doc_id not in changed_positions:
+                _index_question(self.index, position, None, self.question(position))
+                changed[position] = None # Оставляем "дыру", чтобы не сдвигать позиции остальных вопросов.
+                changed_positions[doc_id] = None
+                size -= 1
+        for doc_id, question in upserts.items():
+            position = self.position(doc_id)
+            if position is None: # Новый вопрос добавляется в конец.
+                position = changed_positions[doc_id] = length
+                length += 1
+                size += 1
+                _index_question(self.index, position, question)
+            else: # Измененный вопрос заменяет старый на той же позиции.
+                _index_question(self.index, position, question, self.question(position))
+            changed[position] = question
+        return QuestionBank(self.base_questions, self.base_positions, size, self.index,
+                            self.changed.updated(changed.items()), self.changed_positions.updated(changed_positions.items()), length)
+
+    def needs_rebuild(self):
+        """
+        True, если банк пора собрать заново (см. rebuild_question_bank): удаленных вопросов накопилось больше,
+        чем действующих, или правок больше, чем вопросов в исходном списке. Сборка стоит O(размер банка), но нужна
+        не чаще одного раза на столько изменений, сколько вопросов в банке, то есть в среднем O(1) на изменение.
+        """
+        return (self.length - self.size > max(self.size, QUESTIONS_REFRESH_MAX_BATCH)
+                or len(self.changed) > max(len(self.base_questions), QUESTIONS_REFRESH_MAX_BATCH))
+
+    def sample(self, filters, count, rng):
+        """
+        Выбирает до count разных вопросов, подходящих под filters (словарь поле -> значение), в случайном порядке.
+        Возвращает array позиций вопросов в этом снимке.
+        Списки индекса точные, поэтому сами вопросы при выборе не читаются (это важно для банка из снимка).
+        При нескольких фильтрах подходящие вопросы - пересечение их списков: из самого короткого строится множество,
+        остальные списки проверяются по нему. Так выбор не зависит от того, насколько мало вопросов
+        подходит под все условия сразу, а стоимость пропорциональна суммарной длине списков.
+        При одном фильтре (или без фильтров - весь банк) подходят все кандидаты; если их больше
+        QUIZ_SAMPLE_SCAN_LIMIT, вопросы выбираются случайными пробами, и стоимость зависит от count, а не от размера банка.
+        """
+        if len(filters) > 1:
+            lists = sorted((self.index.get(item, ()) for item in filters.items()), key=len)
+            pool = sorted(set(lists[0]).intersection(*lists[1:])) # sorted - чтобы выбор по зерну был воспроизводим.
+            return array('I', rng.sample(pool, min(count, len(pool))))
+        if filters:
+            candidates = self.index.get(next(iter(filters.items())), ())
+        else:
+            candidates = range(self.length)
+
+        def matches(position):
+            # В списках индекса удаленных вопросов нет; в range(self.length) они отсеиваются по правкам.
+            return self.changed.get(position, _UNCHANGED) is not None
+
+        if len(candidates) <= QUIZ_SAMPLE_SCAN_LIMIT:
+            pool = [position for position in candidates if matches(position)]
+            return array('I', rng.sample(pool, min(count, len(pool))))
+        chosen = {}
+        for _ in range(count * 20): # Ограничиваем число проб, если подходящих вопросов среди кандидатов мало.
+            position = candidates[rng.randrange(len(candidates))]
+            if position not in chosen and matches(position):
+                chosen[position] = None
+                if len(chosen) == count:
+                    break
+        return array('I', chosen)
+
+
+def _index_question(index, position, question, previous=None):
+    """
+    Обновляет списки индекса для вопроса на позиции position: для каждого поля выбора, значение которого изменилось,
+    позиция убирается из списка прежнего значения (из previous) и добавляется в список нового (из question).
+    question=None - вопрос удален: позиция убирается из всех его списков.
+    Списки отсортированы по возрастанию, поэтому позиция ищется двоичным поиском, а не перебором списка.
+    """
+    for field in QUESTION_FILTER_FIELDS:
+        value = question.get(field) if question is not None else None
+        old_value = previous.get(field) if previous is not None else None
+        if value == old_value:
+            continue
+        if old_value is not None:
+            positions = index.get((field, old_value))
+            if positions is not None:
+                number = bisect.bisect_left(positions, position)
+                if number < len(positions) and positions[number] == position:
+                    del positions[number]
+                    if not positions:
+                        del index[(field, old_value)]
+        if value is not None:
+            bisect.insort(index.setdefault((field, value), array('I')), position)
+
+
+def apply_question_changes(application: Application, changes) -> None:
+    """
+    Применяет накопленные изменения коллекции к банку вопросов в application.bot_data.
+    changes - словарь ID документа -> новый документ (или None, если документ удален).
+    Документ с полем deleted: true считается удаленным (мягкое удаление для режима опроса).
+    """
+    upserts = {}
+    deleted_ids = []
+    for doc_id, q_doc in changes.items():
+        if q_doc is None or q_doc.get("deleted"):
+            deleted_ids.append(doc_id)
+            continue
+        question, reasons = validate_question(q_doc)
+        if question is None:
+            # Документ стал некорректным после правки: убираем его из викторины, пока его не исправят.
+            logger.warning("Измененный вопрос (ID: %s) не прошел проверку и убран из викторины: %s", doc_id, ' | '.join(reasons))
+            deleted_ids.append(doc_id)
+        else:
+            upserts[doc_id] = question
+    bank = application.bot_data.get('question_bank', EMPTY_QUESTION_BANK).apply_changes(upserts, deleted_ids)
+    application.bot_data['question_bank'] = bank
+    logger.info("Банк вопросов обновлен: изменено/добавлено %s, удалено %s, всего %s.", len(upserts), len(deleted_ids), len(bank))
+    pending = application.bot_data.get('questions_rebuild_pending')
+    if pending is not None: # Банк собирается заново: эти изменения будут применены и к собранному банку.
+        pending.append((upserts, deleted_ids))
+    elif bank.needs_rebuild():
+        application.bot_data['questions_rebuild_pending'] = []
+        # Индекс общий с новыми снимками и меняется следующими правками, поэтому сборка получает его копию.
+        index = {key: array('I', positions) for key, positions in bank.index.items()}
+        bank = QuestionBank(bank.base_questions, bank.base_positions, bank.size, index, bank.changed, bank.changed_positions, bank.length)
+        application.bot_data['questions_rebuild_task'] = asyncio.create_task(rebuild_question_bank(application, bank))
+
+
+def build_rebuilt_question_bank(bank):
+    """
+    Собирает банк заново, без удаленных вопросов и накопленных правок. Выполняется в рабочем потоке.
+    Банк из снимка записывается в новый снимок и открывается из него, чтобы вопросы оставались общими для процессов;
+    банк из списка собирается в новый список. Возвращает None, если снимок записать не удалось.
+    """
+    if not isinstance(bank.base_questions, SnapshotQuestions):
+        return QuestionBank.from_questions(q for q in bank.iter_questions() if q is not None)
+    try:
+        return write_question_snapshot(bank, QUESTIONS_SNAPSHOT_PATH, reopen=True)
+    except OSError as e:
+        logger.warning("Не удалось записать снимок банка вопросов %s: %s", QUESTIONS_SNAPSHOT_PATH, e)
+        return None
+
+
+def apply_question_change_batches(bank, batches):
+    """Применяет к банку список изменений (upserts, deleted_ids) по порядку и возвращает новый банк."""
+    for upserts, deleted_ids in batches:
+        bank = bank.apply_changes(upserts, deleted_ids)
+    return bank
+
+
+async def rebuild_question_bank(application: Application, bank) -> None:
+    """
+    Фоновая задача: собирает банк bank заново в рабочем потоке, не останавливая event loop, и заменяет им банк
+    в application.bot_data. Изменения, примененные за время сборки, применяются к собранному банку повторно.
+    """
+    started = time.perf_counter()
+    pending = application.bot_data['questions_rebuild_pending']
+    try:
+        rebuilt = await asyncio.to_thread(build_rebuilt_question_bank, bank)
+        # Изменения, пришедшие за время сборки, тоже применяются в рабочем потоке: собранный банк обработчикам
+        # еще не виден. Каждый следующий проход короче предыдущего; число проходов ограничено на случай,
+        # если изменения приходят быстрее, чем применяются, - тогда остаток применяется ниже, в event loop.
+        for _ in range(3):
+            if rebuilt is None or not pending:
+                break
+            batch = pending[:]
+            del pending[:]
+            rebuilt = await asyncio.to_thread(apply_question_change_batches, rebuilt, batch)
+    except Exception as e:
+        logger.error("Не удалось собрать банк вопросов заново: %s", e)
+        rebuilt = None
+    finally:
+        application.bot_data.pop('questions_rebuild_pending')
+        application.bot_data.pop('questions_rebuild_task', None)
+    if rebuilt is None:
+        return
+    rebuilt = application.bot_data['question_bank'] = apply_question_change_batches(rebuilt, pending)
+    logger.info("Банк вопросов собран заново за %.1f с: %s вопросов.", time.perf_counter() - started, len(rebuilt))
+
+
+async def watch_question_changes(application: Application) -> None:
+    """
+    Следит за коллекцией вопросов через change stream и применяет изменения к банку в памяти.
+    Change stream доступен только на replica set; если сервер его не поддерживает,
+    переключаемся на опрос по полю updated_at (poll_question_changes).
+    """
+    resume_token = None # Токен, позволяющий продолжить поток изменений после переподключения без пропусков.
+    while True:
+        changes = {}
+        try:
+            pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+            if resume_token is not None:
+                start = {"resume_after": resume_token}
+            else: # Первое открытие потока: с момента перед загрузкой банка (см. load_question_bank).
+                start = {"start_at_operation_time": application.bot_data.get('questions_operation_time')}
+            async with questions_collection.watch(pipeline, full_document='updateLookup', **start) as stream:
+                logger.info("Отслеживание изменений вопросов через change stream запущено.")
+                while True:
+                    change = await stream.try_next() # None, если новых изменений пока нет.
+                    if change is not None:
+                        # Для delete fullDocument отсутствует; для update он может быть None, если документ уже удален.
+                        changes[change["documentKey"]["_id"]] = change.get("fullDocument")
+                        resume_token = stream.resume_token
+                        if len(changes) < QUESTIONS_REFRESH_MAX_BATCH:
+                            continue
+                    if changes:
+                        apply_question_changes(application, changes)
+                        changes = {}
+                    if change is None:
+                        await asyncio.sleep(QUESTIONS_REFRESH_INTERVAL) # Даем изменениям накопиться в одну пачку.
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            if e.code == 40573: # "The $changeStream stage is only supported on replica sets".
+                logger.warning("Change stream недоступен (MongoDB запущен не как replica set). Переключаемся на опрос по полю updated_at.")
+                await poll_question_changes(application)
+                return
+            logger.error("Ошибка change stream вопросов: %s. Повтор через %s с.", e, QUESTIONS_REFRESH_RETRY_DELAY)
+        except Exception as e:
+            logger.error("Ошибка при отслеживании изменений вопросов: %s. Повтор через %s с.", e, QUESTIONS_REFRESH_RETRY_DELAY)
+        if changes: # Применяем то, что успели получить до ошибки.
+            apply_question_changes(application, changes)
+        await asyncio.sleep(QUESTIONS_REFRESH_RETRY_DELAY)
+
+
+async def poll_question_changes(application: Application) -> None:
+    """
+    Запасной режим обновления: периодически запрашивает документы, у которых updated_at
+    не раньше времени последнего опроса. Удаление в этом режиме выражается полем deleted: true.
+    Каждый опрос читает только измененные документы (по индексу на updated_at), а не всю коллекцию.
+    """
+    since = application.bot_data.get('questions_loaded_at', datetime.now(timezone.utc))
+    try:
+        await questions_collection.create_index("updated_at")
+    except Exception as e:
+        logger.warning("Не удалось создать индекс на updated_at: %s", e)
+    projection = dict(QUESTION_PROJECTION, updated_at=1, deleted=1)
+    boundary_ids = set() # ID документов, уже примененных с меткой времени, равной since.
+    while True:
+        await asyncio.sleep(QUESTIONS_REFRESH_INTERVAL)
+        try:
+            # $gte, а не $gt: документы с той же меткой времени, что и граница, не будут пропущены,
+            # а уже примененные из них отсеиваются по boundary_ids.
+            started = time.perf_counter()
+            cursor = questions_collection.find({"updated_at": {"$gte": since}}, projection=projection).sort("updated_at", 1)
+            changes = {}
+            async for q_doc in cursor:
+                updated_at = q_doc.get("updated_at")
+                if isinstance(updated_at, datetime):
+                    if updated_at.tzinfo is None: # pymongo по умолчанию возвращает время UTC без часового пояса.
+                        updated_at = updated_at.replace(tzinfo=timezone.utc)
+                    if updated_at == since and q_doc["_id"] in boundary_ids:
+                        continue
+                    if updated_at > since:
+                        since = updated_at
+                        boundary_ids = set()
+                    boundary_ids.add(q_doc["_id"])
+                changes[q_doc["_id"]] = q_doc
+                if len(changes) >= QUESTIONS_REFRESH_MAX_BATCH:
+                    apply_question_changes(application, changes)
+                    changes = {}
+            if changes:
+                apply_question_changes(application, changes)
+            mongo_latency.observe(time.perf_counter() - started, "poll_questions")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Ошибка при опросе изменений вопросов: %s", e)
+
+
+EMPTY_QUESTION_BANK = QuestionBank() # Пустой банк, используемый, пока вопросы не загружены.
+
+
+# --- ЛОКАЛЬНЫЙ СНИМОК БАНКА ВОПРОСОВ ---
+# Формат файла (версия SNAPSHOT_VERSION):
+#   заголовок SNAPSHOT_HEADER: сигнатура, версия формата, число вопросов, смещения разделов индекса и ID,
+#   CRC32 всего, что идет после заголовка (проверяется при открытии, чтобы не читать вопросы из поврежденного файла);
+#   таблица смещений: число вопросов + 1 чисел uint64 - начало каждого вопроса в файле и конец последнего;
+#   вопросы: по одному документу BSON на вопрос (только поля SNAPSHOT_FIELDS);
+#   индекс: документ BSON с индексом по полям выбора (списки позиций - массивы uint32);
+#   ID: хеши ID вопросов (uint64, по возрастанию), затем позиции вопросов с этими хешами (uint32), до конца файла.
+# При запуске разбирается только индекс; вопросы и ID читаются из отображенного в память файла при обращении к ним,
+# поэтому страницы с ними - общие для всех процессов бота (страничный кэш ОС), а не копия в памяти каждого процесса.
+SNAPSHOT_MAGIC = b"HEQSNAP\x00"
+SNAPSHOT_VERSION = 3
+SNAPSHOT_HEADER = struct.Struct("<8sIIQQI") # Сигнатура, версия, число вопросов, смещение индекса, смещение ID, CRC32.
+SNAPSHOT_FIELDS = ("_id", "question", "options", "correct_answer", "correct_index", *QUESTION_FILTER_FIELDS)
+
+
+class SnapshotQuestions:
+    """
+    Список вопросов, читаемый из файла снимка, отображенного в память.
+    Вопрос декодируется из BSON и подготавливается (prepare_question) при обращении к нему, поэтому
+    открытие снимка почти не зависит от числа вопросов, а страницы файла - общие для всех процессов бота.
+    Декодированные вопросы хранятся в кэше не больше QUESTIONS_SNAPSHOT_CACHE_SIZE (вытесняются давно не нужные),
+    поэтому память процесса не растет до размера всего банка. Вопрос викторины читается при отправке и снова
+    при ответе; второе чтение почти всегда попадает в кэш, а промахом обходится только отправка вопроса.
+    """
+    __slots__ = ("_buffer", "_offsets", "_cache")
+
+    def __init__(self, buffer, offsets):
+        self._buffer = buffer # memoryview файла снимка.
+        self._offsets = offsets # memoryview таблицы смещений (uint64).
+        self._cache = OrderedDict() # Позиция -> декодированный вопрос, от давно не нужных к недавним.
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def record(self, position):
+        """Возвращает запись вопроса в BSON без декодирования и без обращения к кэшу (можно из любого потока)."""
+        return self._buffer[self._offsets[position]:self._offsets[position + 1]]
+
+    def __getitem__(self, position):
+        question = self._cache.get(position)
+        if question is not None:
+            self._cache.move_to_end(position)
+            return question
+        question = self._cache[position] = prepare_question(bson.decode(self.record(position)))
+        if QUESTIONS_SNAPSHOT_CACHE_SIZE is not None and len(self._cache) > QUESTIONS_SNAPSHOT_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return question
+
+    def __iter__(self):
+        return (self[position] for position in range(len(self)))
+
+
+def _snapshot_id_hash(doc_id):
+    """64-битный хеш ID вопроса для раздела ID снимка (в отличие от hash(), одинаков во всех процессах и запусках)."""
+    return int.from_bytes(hashlib.blake2b(bson.encode({"_id": doc_id}), digest_size=8).digest(), "little")
+
+
+class SnapshotPositions(Mapping):
+    """
+    Словарь ID вопроса -> позиция в снимке, читаемый прямо из раздела ID файла двоичным поиском по хешу ID,
+    без построения словаря в памяти процесса. Позиция с совпавшим хешем проверяется по ID самого вопроса.
+    """
+    __slots__ = ("_hashes", "_positions", "_questions")
+
+    def __init__(self, hashes, positions, questions):
+        self._hashes = hashes # memoryview хешей ID (uint64, по возрастанию).
+        self._positions = positions # memoryview позиций вопросов (uint32) в порядке хешей.
+        self._questions = questions # SnapshotQuestions того же снимка.
+
+    def __getitem__(self, doc_id):
+        key = _snapshot_id_hash(doc_id)
+        number = bisect.bisect_left(self._hashes, key)
+        while number < len(self._hashes) and self._hashes[number] == key:
+            position = self._positions[number]
+            if self._questions[position]["_id"] == doc_id:
+                return position
+            number += 1
+        raise KeyError(doc_id)
+
+    def __iter__(self):
+        return (question["_id"] for question in self._questions)
+
+    def hashes_by_position(self):
+        """Возвращает array хешей ID по позициям вопросов (для перезаписи снимка без декодирования вопросов)."""
+        hashes = array('Q', bytes(8 * len(self._positions)))
+        for key, position in zip(self._hashes, self._positions):
+            hashes[position] = key
+        return hashes
+
+    def __len__(self):
+        return len(self._positions)
+
+
+def write_question_snapshot(bank, path, reopen=False):
+    """
+    Записывает действующие вопросы банка в файл снимка.
+    Файл пишется во временный и затем заменяет старый, поэтому читатель никогда не видит недописанный снимок.
+    Функция не обращается к event loop, поэтому её можно вызывать из рабочего потока. Вопросы снимка, на котором
+    основан банк, переносятся готовыми записями BSON (без декодирования и без обращения к кэшу вопросов), а индекс
+    переносится из bank.index с пересчетом позиций, поэтому он не должен меняться во время записи.
+    reopen=True - вернуть банк, открытый из записанного файла. Файл открывается до переименования, поэтому
+    снимок, записанный по тому же пути другим процессом, его не подменит.
+    """
+    base = bank.base_questions
+    from_snapshot = isinstance(base, SnapshotQuestions)
+    base_hashes = bank.base_positions.hashes_by_position() if from_snapshot else None
+    records = []
+    hashes = array('Q')
+    renumbered = array('I', bytes(4 * bank.length)) # Позиция в банке -> позиция в новом снимке.
+    for position in range(bank.length):
+        question = bank.changed.get(position, _UNCHANGED)
+        if question is None:
+            continue
+        renumbered[position] = len(records)
+        if question is _UNCHANGED and from_snapshot:
+            records.append(base.record(position))
+            hashes.append(base_hashes[position])
+            continue
+        if question is _UNCHANGED:
+            question = base[position]
+        records.append(bson.encode({field: question[field] for field in SNAPSHOT_FIELDS if field in question}))
+        hashes.append(_snapshot_id_hash(question["_id"]))
+    offsets = array('Q')
+    offset = SNAPSHOT_HEADER.size + offsets.itemsize * (len(records) + 1)
+    for record in records:
+        offsets.append(offset)
+        offset += len(record)
+    offsets.append(offset)
+    # Позиции в снимке идут подряд, без удаленных вопросов; списки индекса точные, удаленных позиций в них нет.
+    index_section = bson.encode({"index": [
+        [field, value, array('I', (renumbered[position] for position in positions)).tobytes()]
+        for (field, value), positions in bank.index.items()
+    ]})
+    ids = sorted(zip(hashes, range(len(hashes))))
+    ids_section = array('Q', (key for key, _ in ids)).tobytes() + array('I', (position for _, position in ids)).tobytes()
+    body = [offsets.tobytes(), *records, index_section, ids_section]
+    checksum = 0
+    for part in body:
+        checksum = zlib.crc32(part, checksum)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as snapshot_file:
+        snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(records), offset, offset + len(index_section), checksum))
+        snapshot_file.writelines(body)
+    snapshot = load_question_snapshot(temporary_path) if reopen else None
+    os.replace(temporary_path, path)
+    return snapshot
+
+
+def load_question_snapshot(path):
+    """
+    Открывает файл снимка и возвращает банк вопросов из него.
+    Возвращает None, если файла нет, он поврежден или записан другой версией формата.
+    """
+    if not path:
+        return None
+    try:
+        with open(path, "rb") as snapshot_file:
+            buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        logger.info("Снимок банка вопросов %s не найден; вопросы появятся после загрузки из MongoDB.", path)
+        return None
+    except (OSError, ValueError) as e: # ValueError - пустой файл.
+        logger.warning("Не удалось открыть снимок банка вопросов %s: %s", path, e)
+        return None
+    try:
+        magic, version, count, index_offset, ids_offset, checksum = SNAPSHOT_HEADER.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            logger.warning("Файл %s не является снимком банка вопросов версии %s и будет перезаписан.", path, SNAPSHOT_VERSION)
+            return None
+        view = memoryview(buffer)
+        # Вопросы декодируются лениво, поэтому повреждение записи иначе обнаружилось бы только посреди викторины.
+        if zlib.crc32(view[SNAPSHOT_HEADER.size:]) != checksum:
+            raise ValueError("контрольная сумма не совпадает")
+        offsets = view[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + 8 * (count + 1)].cast('Q')
+        if len(offsets) != count + 1 or offsets[count] != index_offset or not index_offset <= ids_offset <= len(view):
+            raise ValueError("размеры разделов не совпадают с заголовком (файл обрезан?)")
+        if len(view) - ids_offset != 12 * count: # 8 байт хеша и 4 байта позиции на вопрос.
+            raise ValueError("раздел ID обрезан")
+        index = {}
+        for field, value, data in bson.decode(view[index_offset:ids_offset])["index"]:
+            positions = index[(field, value)] = array('I')
+            positions.frombytes(data)
+    except (struct.error, ValueError, TypeError, KeyError, bson.errors.BSONError) as e:
+        logger.warning("Снимок банка вопросов %s поврежден и не будет использован: %s", path, e)
+        return None
+    logger.info("Загружено %s вопросов из снимка %s.", count, path)
+    questions = SnapshotQuestions(view, offsets)
+    hashes = view[ids_offset:ids_offset + 8 * count].cast('Q')
+    positions = view[ids_offset + 8 * count:].cast('I')
+    return QuestionBank(questions, SnapshotPositions(hashes, positions, questions), count, index)
+
+
+# --- СОСТОЯНИЕ ПОЛЬЗОВАТЕЛЕЙ ---
+
+class QuizSession:
+    """
+    Состояние викторины одного пользователя.
+    __slots__ вместо словаря: у объекта нет собственного __dict__, поэтому сессия занимает в несколько раз меньше памяти.
+    """
+    __slots__ = ("score", "current_question", "questions", "order", "seed", "last_active")
+
+    def __init__(self, questions, order, seed=0, score=0, current_question=0):
+        self.score = score # Количество правильных ответов.
+        self.current_question = current_question # Номер текущего вопроса в викторине (индекс в order).
+        self.questions = questions # Снимок банка вопросов, с которым была начата викторина.
+        self.order = order # array позиций вопросов викторины в снимке банка (копия вопросов не создается).
+        self.seed = seed # Зерно генератора, которым выбраны вопросы (позволяет воспроизвести выбор).
+        self.last_active = time.monotonic() # Время последнего действия пользователя (для вытеснения по простою).
+
+    def current(self):
+        """Возвращает текущий вопрос или None, если вопросы закончились."""
+        if self.current_question >= len(self.order):
+            return None
+        return self.questions.question(self.order[self.current_question])
+
+
+async def finish_before_cancel(coroutine):
+    """
+    Выполняет coroutine до конца, даже если ожидающую её задачу отменили; отмена передается дальше после завершения.
+    Нужна для пакетной записи: прерванный на середине сброс терял бы уже снятые для записи изменения.
+    """
+    task = asyncio.ensure_future(coroutine)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        await task
+        raise
+
+
+class SessionStore:
+    """
+    Хранилище состояния викторин пользователей.
+    Активные сессии живут в памяти (OrderedDict ID пользователя -> QuizSession, упорядоченный по последнему
+    обращению), а в коллекцию sessions записываются с отложенной записью (write-behind): изменения только помечают
+    сессию "грязной", а фоновая задача раз в SESSIONS_FLUSH_INTERVAL секунд отправляет все накопленные изменения
+    одним bulk_write. Несколько ответов пользователя между сбросами превращаются в одну запись.
+    После перезапуска бота сессия восстанавливается из MongoDB при первом обращении пользователя.
+    Размер таблицы ограничен: сессии, простаивающие дольше SESSIONS_IDLE_TTL, считаются истекшими и удаляются,
+    а при превышении SESSIONS_MAX_ACTIVE из памяти вытесняются самые давно неактивные (они остаются в MongoDB).
+    Пока коллекции нет (до подключения к MongoDB), изменения не копятся: сессии живут только в таблице, размер которой
+    ограничен, а при подключении все они записываются первым сбросом. Если запись не удалась, вытесненные сессии
+    не удерживаются до следующей попытки, поэтому память ограничена и при недоступной MongoDB.
+    """
+
+    def __init__(self):
+        self.collection = None # Коллекция sessions; None, пока нет подключения к MongoDB (сессии только в памяти).
+        self._sessions = OrderedDict() # ID пользователя -> QuizSession; в начале - давно неактивные, в конце - недавние.
+        self._dirty = {} # ID пользователя -> сессия для записи или None, если сессию нужно удалить из MongoDB.
+        self._expired = OrderedDict() # ID пользователей с недавно истекшими сессиями (для сообщения "сессия истекла").
+        self.expired_count = 0 # Сколько сессий истекло по простою за время работы.
+        self.evicted_count = 0 # Сколько сессий вытеснено из памяти из-за ограничения размера.
+
+    def attach(self, collection):
+        """Подключает коллекцию MongoDB для сохранения сессий; сессии, начатые без неё, запишутся при следующем сбросе."""
+        self.collection = collection
+        self._dirty.update(self._sessions)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def is_expired(self, user_id):
+        """True, если викторина пользователя недавно была удалена из-за простоя."""
+        return user_id in self._expired
+
+    def _mark_expired(self, user_id):
+        """Запоминает ID пользователя с истекшей сессией; список ограничен, чтобы не расти бесконечно."""
+        self.expired_count += 1
+        self._expired[user_id] = None
+        self._expired.move_to_end(user_id)
+        if len(self._expired) > SESSIONS_MAX_ACTIVE:
+            self._expired.popitem(last=False)
+
+    def _remember(self, user_id, session):
+        """Кладет сессию в таблицу как самую свежую и вытесняет самые старые при переполнении."""
+        session.last_active = time.monotonic()
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        while len(self._sessions) > SESSIONS_MAX_ACTIVE:
+            evicted_id, evicted = self._sessions.popitem(last=False)
+            self.evicted_count += 1
+            if self.collection is None:
+                # Без MongoDB вытесненную сессию восстановить будет неоткуда (в _dirty её тоже нет).
+                self._mark_expired(evicted_id)
+            # Иначе несохраненные изменения остаются в _dirty и будут записаны при следующем сбросе.
+
+    async def get(self, user_id, bank):
+        """
+        Возвращает сессию викторины пользователя или None, если активной викторины нет.
+        Если сессии нет в памяти, пытается восстановить её из MongoDB, привязав к текущему банку вопросов bank.
+        """
+        session = self._sessions.get(user_id)
+        if session is not None:
+            session.last_active = time.monotonic()
+            self._sessions.move_to_end(user_id)
+            return session
+        if user_id in self._expired:
+            return None
+        if user_id in self._dirty:
+            # None - викторина завершена или истекла, но еще не удалена из MongoDB: восстанавливать её нельзя.
+            # Сессия - её вытеснили из памяти из-за ограничения размера до записи в MongoDB: возвращаем её в таблицу.
+            session = self._dirty[user_id]
+            if session is not None:
+                self._remember(user_id, session)
+            return session
+        if self.collection is None:
+            return None
+        started = time.perf_counter()
+        try:
+            doc = await self.collection.find_one({"_id": user_id})
+            mongo_latency.observe(time.perf_counter() - started, "session_find_one")
+        except Exception as e:
+            logger.error("Не удалось восстановить сессию пользователя %s из MongoDB: %s", user_id, e)
+            return None
+        if doc is None:
+            return None
+        if user_id in self._sessions or user_id in self._dirty: # Пока шел запрос, состояние пользователя изменилось.
+            return await self.get(user_id, bank)
+        updated_at = doc.get("updated_at")
+        if isinstance(updated_at, datetime):
+            if updated_at.tzinfo is None: # pymongo по умолчанию возвращает время UTC без часового пояса.
+                updated_at = updated_at.replace(tzinfo=timezone.utc)
+            if (datetime.now(timezone.utc) - updated_at).total_seconds() > SESSIONS_IDLE_TTL:
+                self._mark_expired(user_id)
+                self._dirty[user_id] = None # Удаляем брошенную сессию из MongoDB.
+                return None
+        # Вопросы викторины ищутся по их ID: после перезапуска позиции вопросов в банке могут отличаться.
+        # Вопросы, удаленные из банка за это время, пропускаются.
+        positions = [bank.position(q_id) for q_id in doc.get("question_ids", [])]
+        order = array('I', (position for position in positions if position is not None))
+        current_question = sum(1 for position in positions[:doc.get("current_question", 0)] if position is not None)
+        session = QuizSession(bank, order, doc.get("seed", 0), doc.get("score", 0), current_question)
+        self._remember(user_id, session)
+        logger.info("Сессия пользователя %s восстановлена из MongoDB (вопрос %s, счет %s).", user_id, current_question + 1, session.score)
+        return session
+
+    def start(self, user_id, session):
+        """Сохраняет новую викторину пользователя (заменяя предыдущую, если она была)."""
+        self._expired.pop(user_id, None)
+        self._remember(user_id, session)
+        if self.collection is not None:
+            self._dirty[user_id] = session
+
+    def save(self, user_id):
+        """Помечает сессию пользователя измененной; она будет записана в MongoDB при следующем сбросе."""
+        session = self._sessions.get(user_id)
+        if session is not None and self.collection is not None:
+            self._dirty[user_id] = session
+
+    def finish(self, user_id):
+        """Удаляет сессию завершенной викторины из памяти и (при следующем сбросе) из MongoDB."""
+        # Сессия могла быть вытеснена из памяти до записи в MongoDB: тогда она есть только в _dirty.
+        if (self._sessions.pop(user_id, None) is not None or self._dirty.get(user_id) is not None) and self.collection is not None:
+            self._dirty[user_id] = None
+
+    def evict_idle(self):
+        """
+        Удаляет сессии, простаивающие дольше SESSIONS_IDLE_TTL.
+        Таблица упорядочена по последнему обращению, поэтому просматриваются только истекшие сессии в её начале.
+        """
+        deadline = time.monotonic() - SESSIONS_IDLE_TTL
+        expired = 0
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if session.last_active > deadline:
+                break
+            del self._sessions[user_id]
+            self._mark_expired(user_id)
+            if self.collection is not None:
+                self._dirty[user_id] = None # Брошенная викторина удаляется и из MongoDB.
+            expired += 1
+        if expired:
+            logger.info("Удалено %s сессий, простаивавших дольше %s с. Сессий в памяти: %s.", expired, SESSIONS_IDLE_TTL, len(self._sessions))
+
+    async def flush(self):
+        """Записывает все накопленные изменения сессий в MongoDB одним bulk_write."""
+        if not self._dirty or self.collection is None:
+            return
+        dirty, self._dirty = self._dirty, {}
+        now = datetime.now(timezone.utc)
+        operations = []
+        for user_id, session in dirty.items():
+            if session is None:
+                operations.append(DeleteOne({"_id": user_id}))
+                continue
+            bank = session.questions
+            operations.append(UpdateOne({"_id": user_id}, {"$set": {
+                "score": session.score,
+                "current_question": session.current_question,
+                "question_ids": [bank.question(position)["_id"] for position in session.order],
+                "seed": session.seed,
+                "updated_at": now,
+            }}, upsert=True))
+        try:
+            # ordered=False: сервер применяет операции независимо, ошибка в одной не останавливает остальные.
+            started = time.perf_counter()
+            await self.collection.bulk_write(operations, ordered=False)
+            mongo_latency.observe(time.perf_counter() - started, "session_bulk_write")
+        except Exception as e:
+            logger.error("Не удалось сохранить %s сессий в MongoDB: %s. Повторим при следующем сбросе.", len(operations), e)
+            for user_id, session in dirty.items():
+                if session is not None and user_id not in self._sessions and user_id not in self._dirty:
+                    # Сессия вытеснена из памяти и не записана: если держать её до следующей попытки, при недоступной
+                    # MongoDB такие сессии копились бы без ограничения. Пользователь получит сообщение об истечении.
+                    self._mark_expired(user_id)
+                    continue
+                self._dirty.setdefault(user_id, session) # Более свежие изменения, накопленные за время записи, не затираем.
+
+    async def run_flusher(self):
+        """Фоновая задача: периодически удаляет простаивающие сессии и сбрасывает накопленные изменения в MongoDB."""
+        while True:
+            await asyncio.sleep(SESSIONS_FLUSH_INTERVAL)
+            self.evict_idle()
+            await finish_before_cancel(self.flush()) # Остановка бота дожидается окончания записи.
+
+
+session_store = SessionStore() # Единое хранилище сессий викторины для всех обработчиков.
+
+
+# --- СТАТИСТИКА И ТАБЛИЦА ЛИДЕРОВ ---
+
+class StatsStore:
+    """
+    Статистика ответов и таблица лучших игроков.
+    Обработчики только увеличивают счетчики в памяти (O(1) на ответ, без запросов к MongoDB). Фоновая задача
+    раз в STATS_FLUSH_INTERVAL секунд записывает накопленные приращения одним bulk_write на коллекцию ($inc, $max),
+    поэтому тысяча ответов на один вопрос между сбросами превращается в одну операцию.
+    Таблица лидеров (LEADERBOARD_SIZE лучших результатов) хранится в памяти: один раз загружается из user_stats
+    после подключения к MongoDB и затем обновляется при каждой завершенной викторине, а её текст
+    собирается заново только после изменения. Команда /top не обращается к MongoDB.
+    """
+
+    def __init__(self):
+        self.questions_collection = None # Коллекция question_stats; None, пока нет подключения к MongoDB.
+        self.users_collection = None # Коллекция user_stats.
+        self._answers = {} # ID вопроса -> [ответов, правильных ответов] с последнего сброса.
+        self._users = {} # ID пользователя -> [викторин, правильных ответов, вопросов, лучший счет, имя] с последнего сброса.
+        self._top = {} # ID пользователя -> [лучший счет, имя]; не больше LEADERBOARD_SIZE записей.
+        self._top_text = None # Готовый текст таблицы лидеров; None - таблица изменилась и текст нужно собрать заново.
+
+    def attach(self, questions_collection, users_collection):
+        """Подключает коллекции MongoDB для сохранения статистики."""
+        self.questions_collection = questions_collection
+        self.users_collection = users_collection
+
+    def __len__(self):
+        return len(self._answers) + len(self._users)
+
+    def record_answer(self, question_id, correct):
+        """Учитывает ответ на вопрос."""
+        counts = self._answers.get(question_id)
+        if counts is None:
+            counts = self._answers[question_id] = [0, 0]
+        counts[0] += 1
+        if correct:
+            counts[1] += 1
+
+    def record_completion(self, user_id, name, score, total):
+        """Учитывает завершенную викторину пользователя и обновляет таблицу лидеров."""
+        counts = self._users.get(user_id)
+        if counts is None:
+            counts = self._users[user_id] = [0, 0, 0, score, name]
+        counts[0] += 1
+        counts[1] += score
+        counts[2] += total
+        counts[3] = max(counts[3], score)
+        counts[4] = name
+        self._update_top(user_id, name, score)
+
+    def _update_top(self, user_id, name, score):
+        """Обновляет таблицу лидеров результатом score. Таблица короткая, поэтому поиск в ней не зависит от числа игроков."""
+        entry = self._top.get(user_id)
+        if entry is not None:
+            if score <= entry[0] and name == entry[1]:
+                return
+            entry[0] = max(entry[0], score)
+            entry[1] = name
+        elif len(self._top) < LEADERBOARD_SIZE:
+            self._top[user_id] = [score, name]
+        else:
+            # При равенстве счета место остается за тем, кто набрал его раньше.
+            lowest = min(self._top, key=lambda top_id: self._top[top_id][0])
+            if score <= self._top[lowest][0]:
+                return
+            del self._top[lowest]
+            self._top[user_id] = [score, name]
+        self._top_text = None
+
+    def leaderboard(self):
+        """Возвращает текст таблицы лидеров (из кэша, если таблица не менялась)."""
+        if self._top_text is None:
+            ranked = sorted(self._top.values(), key=lambda entry: -entry[0])
+            self._top_text = "\n".join(f"{place}. {name} - {score}" for place, (score, name) in enumerate(ranked, 1))
+        return self._top_text
+
+    async def load_leaderboard(self):
+        """Загружает таблицу лидеров из user_stats одним запросом (по индексу на best_score)."""
+        if self.users_collection is None:
+            return
+        try:
+            await self.users_collection.create_index([("best_score", -1)])
+            started = time.perf_counter()
+            cursor = self.users_collection.find({}, projection={"best_score": 1, "name": 1}).sort("best_score", -1).limit(LEADERBOARD_SIZE)
+            docs = await cursor.to_list(LEADERBOARD_SIZE)
+            mongo_latency.observe(time.perf_counter() - started, "leaderboard_find")
+        except Exception as e:
+            logger.error("Не удалось загрузить таблицу лидеров из MongoDB: %s", e)
+            return
+        for doc in docs:
+            self._update_top(doc["_id"], doc.get("name", ""), doc.get("best_score", 0))
+
+    async def flush(self):
+        """Записывает накопленные приращения счетчиков в MongoDB (по одному bulk_write на коллекцию)."""
+        if self.questions_collection is None or not (self._answers or self._users):
+            return
+        answers, self._answers = self._answers, {}
+        users, self._users = self._users, {}
+        question_operations = [
+            UpdateOne({"_id": question_id}, {"$inc": {"answers": total, "correct": correct}}, upsert=True)
+            for question_id, (total, correct) in answers.items()
+        ]
+        user_operations = [
+            UpdateOne({"_id": user_id}, {
+                "$inc": {"quizzes": quizzes, "correct": correct, "answered": answered},
+                "$max": {"best_score": best_score},
+                "$set": {"name": name},
+            }, upsert=True)
+            for user_id, (quizzes, correct, answered, best_score, name) in users.items()
+        ]
+        # Порядок записи: сначала ответы на вопросы, затем результаты пользователей. При ошибке
+        # приращения возвращаются в память и будут записаны со следующим сбросом.
+        if question_operations and not await self._bulk_write(self.questions_collection, question_operations, "stats_questions_bulk_write"):
+            for question_id, (total, correct) in answers.items():
+                counts = self._answers.setdefault(question_id, [0, 0])
+                counts[0] += total
+                counts[1] += correct
+        if user_operations and not await self._bulk_write(self.users_collection, user_operations, "stats_users_bulk_write"):
+            for user_id, (quizzes, correct, answered, best_score, name) in users.items():
+                counts = self._users.setdefault(user_id, [0, 0, 0, best_score, name])
+                counts[0] += quizzes
+                counts[1] += correct
+                counts[2] += answered
+                counts[3] = max(counts[3], best_score)
+
+    async def _bulk_write(self, collection, operations, operation_name):
+        """Выполняет bulk_write и возвращает True при успехе."""
+        try:
+            # ordered=False: сервер применяет операции независимо, ошибка в одной не останавливает остальные.
+            started = time.perf_counter()
+            await collection.bulk_write(operations, ordered=False)
+            mongo_latency.observe(time.perf_counter() - started, operation_name)
+            return True
+        except Exception as e:
+            logger.error("Не удалось записать статистику (%s операций) в MongoDB: %s. Повторим при следующем сбросе.", len(operations), e)
+            return False
+
+    async def run_flusher(self):
+        """
+        Фоновая задача: периодически записывает накопленную статистику в MongoDB.
+        В режиме нескольких процессов каждый процесс видит только результаты своих пользователей,
+        поэтому после сброса таблица лидеров перечитывается из MongoDB (один запрос за период, а не на команду).
+        """
+        while True:
+            await asyncio.sleep(STATS_FLUSH_INTERVAL)
+            # Отмена задачи при остановке бота не прерывает запись: снятые для неё приращения иначе были бы потеряны.
+            await finish_before_cancel(self.flush())
+            if WORKER_PROCESSES > 1:
+                await self.load_leaderboard()
+
+
+stats = StatsStore() # Статистика ответов и таблица лидеров для всех обработчиков.
+
+
+# --- ОТПРАВКА СООБЩЕНИЙ В TELEGRAM ---
+
+class TokenBucket:
+    """
+    Ограничитель частоты "ведро с токенами": пополняется со скоростью rate токенов в секунду, вмещает не больше capacity.
+    Каждый запрос забирает один токен; если токенов нет, take() возвращает, сколько секунд нужно подождать.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Забирает токен и возвращает 0 или, если токенов нет, время ожидания (в секундах) без списания токена."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def reserve(self):
+        """Забирает токен "в долг" и возвращает, сколько секунд нужно подождать, прежде чем им воспользоваться."""
+        self._refill()
+        self.tokens -= 1
+        return max(0, -self.tokens / self.rate)
+
+    def full(self):
+        """True, если ведро пополнилось до capacity: такое ведро ничем не отличается от нового."""
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+    def pause(self, seconds):
+        """Опустошает ведро так, чтобы следующий токен появился не раньше чем через seconds секунд (после ответа 429)."""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class OutboundRequest:
+    """Один запрос к Telegram Bot API в очереди отправки."""
+    __slots__ = ("method", "kwargs", "fallback", "attempts")
+
+    def __init__(self, method, kwargs, fallback=None):
+        self.method = method # Имя метода telegram.Bot, например 'send_message'.
+        self.kwargs = kwargs # Аргументы метода.
+        self.fallback = fallback # Аргументы send_message на случай, если редактирование сообщения не удалось.
+        self.attempts = 0 # Сколько раз запрос уже выполнялся.
+
+
+class OutboundDispatcher:
+    """
+    Очередь исходящих запросов к Telegram.
+    Обработчики только ставят запросы в очередь и сразу возвращаются, не дожидаясь ответа Telegram.
+    Запросы одного чата выполняются строго по порядку, а частота отправки ограничивается общим
+    ведром токенов (OUTBOUND_GLOBAL_RATE) и ведром каждого чата (OUTBOUND_CHAT_RATE).
+    На ответ 429 (RetryAfter) чат ставится на паузу на указанное Telegram время, после чего запрос повторяется.
+    Если не удалось отредактировать сообщение с результатом ответа, результат объединяется со следующим
+    вопросом в одно сообщение вместо двух отдельных.
+    """
+
+    def __init__(self, global_rate=None):
+        # global_rate - доля общего лимита OUTBOUND_GLOBAL_RATE, доступная этому процессу (в режиме нескольких процессов).
+        global_rate = global_rate or OUTBOUND_GLOBAL_RATE
+        self.bot = None # Объект telegram.Bot; задается в start().
+        self._chats = {} # ID чата -> deque запросов, ожидающих отправки.
+        self._chat_buckets = {} # ID чата -> TokenBucket (удаляется, когда ведро пополнилось до полного).
+        self._buckets_pruned_at = time.monotonic() # Когда последний раз удалялись полные ведра чатов.
+        self._global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self._ready = None # asyncio.Queue ID чатов, у которых есть запросы и которые никто сейчас не обрабатывает.
+        self._workers = []
+        self._answers = set() # Выполняющиеся ответы на нажатия кнопок.
+
+    def start(self, bot):
+        """Запускает задачи, выполняющие запросы из очереди."""
+        self.bot = bot
+        self._ready = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(OUTBOUND_WORKERS)]
+
+    async def stop(self, timeout=5):
+        """Дожидается отправки накопившихся запросов (не дольше timeout секунд) и останавливает задачи."""
+        deadline = time.monotonic() + timeout
+        while (self._chats or self._answers) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def __len__(self):
+        return sum(len(requests) for requests in self._chats.values())
+
+    def _enqueue(self, chat_id, request):
+        requests = self._chats.get(chat_id)
+        if requests is None: # У чата не было запросов: ставим его в очередь на обработку.
+            self._chats[chat_id] = deque([request])
+            self._ready.put_nowait(chat_id)
+        else: # Чат уже в очереди или обрабатывается: запрос выполнится после предыдущих.
+            requests.append(request)
+
+    def send_message(self, chat_id, **kwargs):
+        """Ставит в очередь отправку сообщения в чат chat_id."""
+        self._enqueue(chat_id, OutboundRequest('send_message', dict(kwargs, chat_id=chat_id)))
+
+    def edit_message_text(self, chat_id, message_id, fallback=None, **kwargs):
+        """
+        Ставит в очередь редактирование сообщения.
+        fallback - аргументы send_message, которые будут отправлены новым сообщением, если редактирование не удастся.
+        """
+        request = OutboundRequest('edit_message_text', dict(kwargs, chat_id=chat_id, message_id=message_id), fallback)
+        self._enqueue(chat_id, request)
+
+    def answer_callback_query(self, callback_query_id, **kwargs):
+        """
+        Отвечает на нажатие inline-кнопки в фоне.
+        На answerCallbackQuery не распространяются лимиты сообщений, поэтому он не ждет в очереди чата:
+        "часики" на кнопке должны исчезнуть сразу, даже если сообщения в этот чат сейчас придерживаются.
+        """
+        request = OutboundRequest('answer_callback_query', dict(kwargs, callback_query_id=callback_query_id))
+        task = asyncio.create_task(self._perform(None, request))
+        self._answers.add(task) # Храним ссылку, чтобы задачу не удалил сборщик мусора до завершения.
+        task.add_done_callback(self._answers.discard)
+
+    def _requeue_later(self, chat_id, delay):
+        """Возвращает чат в очередь на обработку через delay секунд."""
+        asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+
+    def _release(self, chat_id):
+        """Завершает обработку запроса чата: ставит чат обратно в очередь, если у него остались запросы."""
+        if self._chats.get(chat_id):
+            self._ready.put_nowait(chat_id)
+        else:
+            self._chats.pop(chat_id, None)
+            self._prune_buckets()
+
+    def _prune_buckets(self):
+        """
+        Удаляет ведра чатов, пополнившиеся до полного (чат простаивал не меньше OUTBOUND_CHAT_BURST / OUTBOUND_CHAT_RATE
+        секунд): новое ведро для такого чата будет точно таким же. Ведро нельзя удалять, как только очередь чата
+        опустела: тогда следующий ответ пользователя получал бы полный запас токенов и лимит чата не действовал бы
+        между ответами. Проверка выполняется не чаще раза за это время, поэтому в среднем стоит O(1) на запрос.
+        """
+        now = time.monotonic()
+        if now - self._buckets_pruned_at < OUTBOUND_CHAT_BURST / OUTBOUND_CHAT_RATE:
+            return
+        self._buckets_pruned_at = now
+        self._chat_buckets = {chat_id: bucket for chat_id, bucket in self._chat_buckets.items() if not bucket.full()}
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            requests = self._chats.get(chat_id)
+            if not requests:
+                self._release(chat_id)
+                continue
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+            wait = bucket.take()
+            if wait: # Лимит чата исчерпан: не занимаем задачу ожиданием, а возвращаем чат в очередь позже.
+                self._requeue_later(chat_id, wait)
+                continue
+            wait = self._global_bucket.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+            request = requests.popleft()
+            retry_delay = await self._perform(chat_id, request)
+            if retry_delay is not None: # Запрос нужно повторить: возвращаем его в начало очереди чата.
+                requests.appendleft(request)
+                self._requeue_later(chat_id, retry_delay)
+            else:
+                self._release(chat_id)
+
+    async def _perform(self, chat_id, request):
+        """
+        Выполняет запрос. Возвращает None, если запрос обработан (успешно или окончательно неудачно),
+        или задержку в секундах, через которую его нужно повторить.
+        """
+        request.attempts += 1
+        started = time.perf_counter()
+        try:
+            await getattr(self.bot, request.method)(**request.kwargs)
+            return None
+        except Exception as e:
+            telegram_errors.inc(type(e).__name__)
+            return self._handle_error(chat_id, request, e)
+        finally:
+            telegram_latency.observe(time.perf_counter() - started, request.method)
+
+    def _handle_error(self, chat_id, request, error):
+        """Решает, что делать с запросом после ошибки: None - больше не повторять, число - повторить через столько секунд."""
+        if isinstance(error, RetryAfter):
+            retry_after = error.retry_after
+            seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after
+            logger.warning("Telegram ограничил частоту запросов в чат %s: повтор через %s с.", chat_id, seconds)
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is not None:
+                bucket.pause(seconds)
+            return seconds if chat_id is not None else None # Ответ на нажатие кнопки повторять бессмысленно.
+        if isinstance(error, BadRequest): # BadRequest - подкласс NetworkError, поэтому проверяется раньше.
+            if request.fallback is not None:
+                # Если редактирование не удалось (например, сообщение слишком старое), отправляем результат новым сообщением.
+                logger.warning("Не удалось отредактировать сообщение в чате %s: %s. Отправляем результат новым сообщением.", chat_id, error)
+                edit_fallbacks_total.inc()
+                self._send_fallback(chat_id, request.fallback)
+            else:
+                logger.error("Telegram отклонил запрос %s в чат %s: %s", request.method, chat_id, error)
+            return None
+        if isinstance(error, NetworkError):
+            if request.attempts <= OUTBOUND_MAX_RETRIES:
+                logger.warning("Сетевая ошибка при запросе %s в чат %s: %s. Повтор %s/%s.", request.method, chat_id, error, request.attempts, OUTBOUND_MAX_RETRIES)
+                return request.attempts # Увеличиваем паузу с каждой попыткой.
+            logger.error("Не удалось выполнить запрос %s в чат %s после %s попыток: %s", request.method, chat_id, OUTBOUND_MAX_RETRIES, error)
+            return None
+        if isinstance(error, TelegramError): # Например, пользователь заблокировал бота (Forbidden).
+            logger.error("Ошибка Telegram при запросе %s в чат %s: %s", request.method, chat_id, error)
+            return None
+        logger.error("Непредвиденная ошибка при запросе %s в чат %s: %s", request.method, chat_id, error)
+        return None
+
+    def _send_fallback(self, chat_id, fallback):
+        """
+        Отправляет результат ответа новым сообщением. Если следом в очереди чата стоит отправка следующего вопроса,
+        результат и вопрос объединяются в одно сообщение: вместо двух запросов к Telegram выполняется один.
+        """
+        requests = self._chats.get(chat_id)
+        following = requests[0] if requests else None
+        if following is not None and following.method == 'send_message' and following.kwargs.get('parse_mode') is None:
+            text = following.kwargs['text']
+            if fallback.get('parse_mode'):
+                # Текст вопроса не содержит разметки: экранируем его, чтобы объединенное сообщение можно было разобрать как Markdown.
+                text = escape_markdown(text)
+                following.kwargs['parse_mode'] = fallback['parse_mode']
+            following.kwargs['text'] = f"{fallback['text']}\n\n{text}"
+            return
+        fallback_request = OutboundRequest('send_message', dict(fallback, chat_id=chat_id))
+        if requests is None:
+            self._chats[chat_id] = deque([fallback_request])
+        else:
+            requests.appendleft(fallback_request)
+
+
+outbound = OutboundDispatcher() # Единая очередь исходящих запросов к Telegram для всех обработчиков.
+
+
+# --- ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ---
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает до max_concurrent_updates обновлений одновременно, но обновления одного пользователя - строго
+    по очереди. Обработчики меняют сессию пользователя (счет, текущий вопрос) между await; без такой очереди
+    два быстрых нажатия одного пользователя могли бы обработаться вперемешку.
+    """
+    __slots__ = ("_user_locks",)
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {} # ID пользователя -> [asyncio.Lock, число обновлений, ожидающих или держащих блокировку].
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None: # Обновление без пользователя не затрагивает сессии.
+            await coroutine
+            return
+        entry = self._user_locks.get(user.id)
+        if entry is None:
+            entry = self._user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]: # Блокировка больше никому не нужна: удаляем, чтобы словарь не рос.
+                del self._user_locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 
 # --- ОБРАБОТЧИКИ КОМАНД (АСИНХРОННЫЕ) ---
 # Эти функции вызываются, когда пользователь отправляет боту определенную команду (например, /start).
 
+@instrumented("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обработчик команды /start. Отправляет приветственное сообщение.
@@ -154,36 +1819,78 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     'context' - словарь для обмена данными между обработчиками или хранения данных бота.
     """
     user_name = update.effective_user.first_name # Получаем имя пользователя.
-    # Отправляем ответное сообщение пользователю. 'await' используется для асинхронной отправки.
-    await update.message.reply_text(
-        f'Привет, {user_name}! 👋\n'
+    # Ставим ответное сообщение в очередь отправки; обработчик не ждет ответа Telegram.
+    outbound.send_message(
+        update.effective_chat.id,
+        text=f'Привет, {user_name}! 👋\n'
         'Добро пожаловать в викторину! 🧠\n'
-        'Нажми /quiz, чтобы начать игру.'
+        'Нажми /quiz, чтобы начать игру.\n'
+        'Лучшие результаты: /top'
     )
 
 
+@instrumented("top")
+async def top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обработчик команды /top. Показывает таблицу лучших результатов из памяти, без запроса к MongoDB.
+    """
+    leaderboard = stats.leaderboard()
+    outbound.send_message(
+        update.effective_chat.id,
+        text=f"🏆 Лучшие результаты:\n{leaderboard}" if leaderboard else "Пока никто не завершил викторину. Будьте первым: /quiz"
+    )
+
+
+@instrumented("quiz")
 async def quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обработчик команды /quiz. Начинает новую викторину для пользователя.
+    Необязательные аргументы вида поле=значение ограничивают выбор вопросов,
+    например: /quiz category=революции difficulty=2 era=1917-1923.
     """
     user_id = update.effective_user.id # Уникальный идентификатор пользователя.
-    # Получаем предварительно загруженные вопросы из context.bot_data.
+    chat_id = update.effective_chat.id
+    # Получаем предварительно загруженный банк вопросов из context.bot_data.
     # Это эффективнее, чем загружать их из БД каждый раз при вызове /quiz.
-    questions = context.bot_data.get('quiz_questions', [])
+    questions = context.bot_data.get('question_bank', EMPTY_QUESTION_BANK)
 
     if not questions: # Если вопросы не загружены (например, БД пуста или ошибка при старте).
-        await update.message.reply_text(
-            "Извините, пока нет доступных вопросов для викторины. Пожалуйста, добавьте вопросы в базу данных."
+        outbound.send_message(
+            chat_id,
+            text="Извините, пока нет доступных вопросов для викторины. Пожалуйста, добавьте вопросы в базу данных."
         )
         return # Завершаем обработку, если нет вопросов.
 
+    # Разбираем фильтры из аргументов команды.
+    filters = {}
+    for argument in context.args or []:
+        field, _, value = argument.partition("=")
+        value = normalize_filter_value(value)
+        if field not in QUESTION_FILTER_FIELDS or value is None:
+            outbound.send_message(
+                chat_id,
+                text=f"Не понимаю условие «{argument}». Пример: /quiz category=революции difficulty=2 era=1917-1923"
+            )
+            return
+        filters[field] = value
+
+    # Выбираем вопросы викторины по индексу банка. В сессии хранится только массив их позиций и зерно генератора.
+    seed = random.getrandbits(32)
+    order = questions.sample(filters, QUIZ_LENGTH, random.Random(seed))
+    if not order:
+        outbound.send_message(chat_id, text="Нет вопросов, подходящих под выбранные условия. Попробуйте другие.")
+        return
+
     # Инициализируем или сбрасываем состояние викторины для данного пользователя.
-    user_state[user_id] = {"score": 0, "current_question": 0}
-    logger.info(f"Пользователь {user_id} начал викторину.")
+    # Снимок банка вопросов запоминается в состоянии: обновления банка во время игры её не затрагивают.
+    session_store.start(user_id, QuizSession(questions, order, seed))
+    quizzes_total.inc("started")
+    log_event("quiz_started", "Пользователь %s начал викторину.", user_id)
     # Вызываем функцию для отправки первого вопроса.
     await send_question(update, context)
 
 
+@instrumented("send_question")
 async def send_question(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Отправляет текущий вопрос викторины пользователю или сообщение о завершении викторины.
@@ -194,125 +1901,142 @@ async def send_question(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id # Получаем ID чата, чтобы знать, куда отправлять сообщение.
 
-    questions = context.bot_data.get('quiz_questions') # Список всех вопросов викторины.
+    state = await session_store.get(user_id, context.bot_data.get('question_bank', EMPTY_QUESTION_BANK))
+    # Текущий вопрос берется из снимка банка, с которым пользователь начал викторину.
+    question_data = state.current() if state else None
 
     # Проверяем, есть ли активная викторина для пользователя и не закончились ли вопросы.
-    if user_id not in user_state or user_state[user_id]["current_question"] >= len(questions):
+    if question_data is None:
         # Викторина завершена или не была начата для этого пользователя.
-        final_score = user_state.get(user_id, {}).get('score', 0) # Получаем итоговый счет.
-        total_questions = len(questions) if questions else 0
+        final_score = state.score if state else 0 # Получаем итоговый счет.
+        total_questions = len(state.order) if state else 0
         # Отправляем сообщение о завершении.
-        await context.bot.send_message(
-            chat_id=chat_id,
+        outbound.send_message(
+            chat_id,
             text=f"Викторина завершена! 🎉\n"
                  f"Ваш итоговый счет: {final_score} из {total_questions}."
         )
-        if user_id in user_state: # Удаляем состояние пользователя, так как викторина окончена.
-            del user_state[user_id]
-        logger.info(f"Викторина для пользователя {user_id} завершена. Счет: {final_score}")
+        if state is not None:
+            quizzes_total.inc("completed")
+            stats.record_completion(user_id, update.effective_user.first_name, final_score, total_questions)
+        session_store.finish(user_id) # Удаляем состояние пользователя, так как викторина окончена.
+        log_event("quiz_completed", "Викторина для пользователя %s завершена. Счет: %s", user_id, final_score)
         return
 
-    # Получаем индекс текущего вопроса для пользователя.
-    current_question_index = user_state[user_id]["current_question"]
-    question_data = questions[current_question_index] # Получаем данные текущего вопроса.
+    # Получаем номер текущего вопроса для пользователя.
+    current_question_index = state.current_question
     question_text = question_data.get("question", "Ошибка: нет текста вопроса.")
     options = question_data.get("options", [])
 
     if not options: # Обработка случая, если у вопроса нет вариантов ответа (ошибка в данных).
-        logger.error(f"Нет вариантов ответа для вопроса: {question_text} (ID пользователя: {user_id}). Пропускаем вопрос.")
-        await context.bot.send_message(
-            chat_id=chat_id,
+        logger.error("Нет вариантов ответа для вопроса: %s (ID пользователя: %s). Пропускаем вопрос.", question_text, user_id)
+        outbound.send_message(
+            chat_id,
             text="Произошла ошибка при загрузке вариантов ответа для этого вопроса. Переходим к следующему."
         )
-        user_state[user_id]["current_question"] += 1 # Переходим к следующему вопросу.
+        state.current_question += 1 # Переходим к следующему вопросу.
+        session_store.save(user_id)
         await send_question(update, context) # Рекурсивно вызываем отправку следующего вопроса.
         return
 
-    # Создаем inline-клавиатуру с вариантами ответов.
-    # Inline-кнопки отображаются под сообщением.
-    keyboard = []
-    for i, option_text in enumerate(options):
-        # Каждая кнопка содержит текст (option_text) и callback_data (индекс варианта 'i').
-        # callback_data будет отправлена боту при нажатии на кнопку.
-        keyboard.append([InlineKeyboardButton(option_text, callback_data=str(i))])
-
-    reply_markup = InlineKeyboardMarkup(keyboard) # Объект клавиатуры.
-
     # Отправляем вопрос пользователю вместе с клавиатурой.
-    # Каждый новый вопрос отправляется новым сообщением.
-    await context.bot.send_message(
-        chat_id=chat_id,
+    # Inline-клавиатура с вариантами ответов подготовлена заранее при загрузке вопроса (prepare_question).
+    # Каждый новый вопрос отправляется новым сообщением; запрос выполнит очередь отправки outbound.
+    outbound.send_message(
+        chat_id,
         text=question_text,
-        reply_markup=reply_markup
+        reply_markup=question_data["reply_markup"]
     )
-    logger.info(f"Вопрос {current_question_index + 1} отправлен пользователю {user_id}.")
+    log_event("question_sent", "Вопрос %s отправлен пользователю %s.", current_question_index + 1, user_id)
 
 
+@instrumented("check_answer")
 async def check_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обработчик нажатий на inline-кнопки (ответы на вопросы викторины).
     """
     query = update.callback_query # Объект, содержащий информацию о нажатой кнопке.
     user_id = query.from_user.id # ID пользователя, нажавшего кнопку.
+    chat_id = update.effective_chat.id # ID чата и сообщения с кнопкой, которое будет отредактировано.
+    message_id = query.message.message_id
 
+    # Все запросы к Telegram ставятся в очередь outbound, и обработчик сразу возвращается.
     # Обязательно нужно ответить на callback_query, чтобы клиент Telegram
     # понял, что нажатие обработано (исчезнут "часики" на кнопке).
-    await query.answer()
+    # Для повторного нажатия на уже отвеченный вопрос ответ отправляется ниже, с пояснением.
+    answer_token, _, selected = query.data.rpartition(":") # callback_data имеет вид "метка:индекс варианта".
+    if not selected.isdigit(): # Некорректные данные кнопки.
+        outbound.answer_callback_query(query.id)
+        return
 
-    if user_id not in user_state: # Если состояние пользователя не найдено (например, викторина не начата).
+    # Состояние берется из памяти, а после перезапуска бота - восстанавливается из MongoDB.
+    state = await session_store.get(user_id, context.bot_data.get('question_bank', EMPTY_QUESTION_BANK))
+    if state is None: # Если состояние пользователя не найдено (например, викторина не начата).
+        outbound.answer_callback_query(query.id)
         # Редактируем сообщение, к которому была прикреплена кнопка.
-        await query.edit_message_text("Викторина не запущена. Нажмите /quiz, чтобы начать новую игру.")
+        if session_store.is_expired(user_id): # Викторина была брошена и удалена по простою.
+            outbound.edit_message_text(chat_id, message_id, text="Время сессии истекло. Нажмите /quiz, чтобы начать новую игру.")
+        else:
+            outbound.edit_message_text(chat_id, message_id, text="Викторина не запущена. Нажмите /quiz, чтобы начать новую игру.")
         return
 
-    current_question_index = user_state[user_id]["current_question"]
-    questions = context.bot_data.get('quiz_questions')
+    current_question_index = state.current_question
+    total_questions = len(state.order) # Количество вопросов в этой викторине.
+    question_data = state.current() # Данные текущего вопроса (из снимка банка этой викторины).
 
     # Проверка, не отвечает ли пользователь на вопрос, который уже "пройден" или если викторина завершена.
-    if current_question_index >= len(questions):
-        await query.edit_message_text(
-            f"Викторина уже завершена! Ваш счет: {user_state[user_id]['score']} из {len(questions)}."
+    if question_data is None:
+        outbound.answer_callback_query(query.id)
+        outbound.edit_message_text(
+            chat_id, message_id,
+            text=f"Викторина уже завершена! Ваш счет: {state.score} из {total_questions}."
         )
         return
 
-    question_data = questions[current_question_index] # Данные текущего вопроса.
+    # Кнопка относится к другому вопросу: например, пользователь дважды быстро нажал кнопку
+    # или нажал кнопку в старом сообщении. Такое нажатие не должно засчитываться за текущий вопрос.
+    # (У кнопок, отправленных до появления меток, метки нет - они принимаются как раньше.)
+    if answer_token and answer_token != question_data["answer_token"]:
+        outbound.answer_callback_query(query.id, text="На этот вопрос вы уже ответили.")
+        return
+    outbound.answer_callback_query(query.id)
+
     correct_answer_index = question_data.get("correct_index") # Правильный индекс.
-    correct_answer_text = question_data.get("correct_answer") # Текст правильного ответа.
-    selected_answer_index = int(query.data) # Индекс, выбранный пользователем (из callback_data).
+    selected_answer_index = int(selected) # Индекс, выбранный пользователем (из callback_data).
 
     response_message_suffix = "" # Дополнение к сообщению с вопросом (результат ответа).
-    if selected_answer_index == correct_answer_index: # Если ответ правильный.
-        user_state[user_id]["score"] += 1 # Увеличиваем счет.
-        response_message_suffix = f"✅ Правильно!"
-        logger.info(f"Пользователь {user_id} ответил правильно на вопрос {current_question_index + 1}.")
+    is_correct = selected_answer_index == correct_answer_index
+    stats.record_answer(question_data["_id"], is_correct) # Счетчик в памяти; в MongoDB попадет со следующим сбросом.
+    if is_correct: # Если ответ правильный.
+        state.score += 1 # Увеличиваем счет.
+        response_message_suffix = CORRECT_ANSWER_SUFFIX
+        answers_total.inc("correct")
+        log_event("answer", "Пользователь %s ответил правильно на вопрос %s.", user_id, current_question_index + 1)
     else: # Если ответ неправильный.
-        # Markdown используется для выделения правильного ответа (*текст* -> курсив).
-        response_message_suffix = f"❌ Неправильно. Правильный ответ: *{correct_answer_text}*."
-        logger.info(f"Пользователь {user_id} ответил неправильно на вопрос {current_question_index + 1}.")
+        # Текст с правильным ответом подготовлен заранее при загрузке вопроса (prepare_question).
+        response_message_suffix = question_data["incorrect_suffix"]
+        answers_total.inc("incorrect")
+        log_event("answer", "Пользователь %s ответил неправильно на вопрос %s.", user_id, current_question_index + 1)
 
     # Формируем полный текст для отредактированного сообщения.
-    current_score_text = f"Ваш текущий счет: {user_state[user_id]['score']} из {len(questions)}."
+    current_score_text = f"Ваш текущий счет: {state.score} из {total_questions}."
     full_response_text = f"{query.message.text}\n\n{response_message_suffix}\n{current_score_text}"
 
-    try:
-        # Редактируем сообщение с вопросом:
-        # - Добавляем результат ответа.
-        # - Убираем кнопки, передавая пустую InlineKeyboardMarkup.
-        await query.edit_message_text(
-            text=full_response_text,
-            reply_markup=InlineKeyboardMarkup([]), # Пустая клавиатура, чтобы убрать кнопки после ответа.
-            parse_mode='Markdown' # Включаем разбор Markdown для форматирования.
-        )
-    except Exception as e:
-        # Если редактирование не удалось (например, сообщение слишком старое),
-        # просто отправляем результат новым сообщением.
-        logger.warning(f"Не удалось отредактировать сообщение после ответа (пользователь {user_id}): {e}. Отправляем результат новым сообщением.")
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=f"{response_message_suffix}\n{current_score_text}", # Отправляем только результат.
-            parse_mode='Markdown'
-        )
+    # Редактируем сообщение с вопросом:
+    # - Добавляем результат ответа.
+    # - Убираем кнопки, передавая пустую InlineKeyboardMarkup.
+    # Если редактирование не удастся (например, сообщение слишком старое), очередь отправки
+    # отправит результат новым сообщением (fallback), по возможности вместе со следующим вопросом.
+    outbound.edit_message_text(
+        chat_id, message_id,
+        text=full_response_text,
+        reply_markup=EMPTY_REPLY_MARKUP, # Пустая клавиатура, чтобы убрать кнопки после ответа.
+        parse_mode='Markdown', # Включаем разбор Markdown для форматирования.
+        fallback={"text": f"{response_message_suffix}\n{current_score_text}", "parse_mode": 'Markdown'} # Только результат.
+    )
 
-    user_state[user_id]["current_question"] += 1 # Переходим к следующему вопросу.
+    state.current_question += 1 # Переходим к следующему вопросу.
+    session_store.save(user_id) # Изменение попадет в MongoDB со следующим пакетным сбросом.
     # Отправляем следующий вопрос или сообщение о завершении викторины.
     # `update` (CallbackQuery) передается, чтобы `send_question` мог использовать `update.effective_chat.id` и `update.effective_user.id`.
     await send_question(update, context)
@@ -322,49 +2046,340 @@ async def post_init_setup(application: Application) -> None:
     """
     Асинхронная функция, выполняемая один раз после инициализации Application,
     но перед началом приема обновлений от Telegram.
-    Используется для подключения к БД и предварительной загрузки данных (вопросов).
+    Загружает банк вопросов из локального снимка и запускает фоновые задачи: подключение к БД с загрузкой вопросов
+    и сохранение сессий.
     """
     logger.info("Выполняется post_init_setup...")
-    if not await connect_to_mongodb(): # Пытаемся подключиться к MongoDB.
-        logger.critical("Критическая ошибка: не удалось подключиться к MongoDB при запуске. Викторина не будет работать с вопросами из БД.")
-        # Бот продолжит работу, но вопросы не будут загружены.
-        application.bot_data['quiz_questions'] = [] # Устанавливаем пустой список вопросов.
-        return
+    outbound.start(application.bot) # Запускаем очередь исходящих запросов к Telegram.
+    await start_metrics_server(application)
+    # Бот начинает отвечать сразу, не дожидаясь MongoDB: до загрузки вопросов из БД используется локальный снимок.
+    # В режиме нескольких процессов банк загружен основным процессом до их запуска.
+    if 'question_bank' not in application.bot_data:
+        application.bot_data['question_bank'] = load_question_snapshot(QUESTIONS_SNAPSHOT_PATH) or EMPTY_QUESTION_BANK
+
+    # Подключение к MongoDB, загрузка вопросов и применение дальнейших правок коллекции идут в фоне.
+    # Сессии викторин сохраняются в MongoDB пачками с периодом SESSIONS_FLUSH_INTERVAL (после подключения к ней).
+    application.bot_data['background_tasks'] = [
+        asyncio.create_task(sync_question_bank(application)),
+        asyncio.create_task(session_store.run_flusher()),
+        asyncio.create_task(stats.run_flusher()),
+    ]
+
 
-    # Загружаем вопросы из БД и сохраняем их в application.bot_data.
-    # application.bot_data - это словарь, доступный во всех обработчиках через context.bot_data.
-    # Это позволяет загрузить вопросы один раз при старте, а не при каждом вызове /quiz.
+async def sync_question_bank(application: Application) -> None:
+    """
+    Фоновая задача: подключается к MongoDB, заменяет банк вопросов загруженным из БД и затем следит за изменениями
+    коллекции. Пока MongoDB недоступна, попытки повторяются с паузой, которая удваивается после каждой неудачи
+    (от MONGO_RETRY_INITIAL_DELAY до MONGO_RETRY_MAX_DELAY секунд, со случайным разбросом, чтобы несколько
+    процессов не обращались к серверу одновременно).
+    """
+    delay = MONGO_RETRY_INITIAL_DELAY
+    connected = False
+    while True:
+        connected = connected or await connect_to_mongodb()
+        # Банк, уже загруженный из MongoDB основным процессом (режим нескольких процессов), повторно не загружается.
+        if connected and ('questions_loaded_at' in application.bot_data or await load_question_bank(application.bot_data)):
+            break
+        if not connected and mongo_client is not None:
+            mongo_client.close() # Новый клиент создается при следующей попытке.
+        pause = delay * random.uniform(0.5, 1)
+        logger.warning("Вопросы из MongoDB не загружены; следующая попытка через %.1f с.", pause)
+        await asyncio.sleep(pause)
+        delay = min(delay * 2, MONGO_RETRY_MAX_DELAY)
+    await stats.load_leaderboard()
+    await watch_question_changes(application)
+
+
+async def load_question_bank(bot_data) -> bool:
+    """
+    Загружает вопросы из БД, сохраняет банк вопросов в bot_data и записывает его локальный снимок.
+    application.bot_data - это словарь, доступный во всех обработчиках через context.bot_data.
+    Это позволяет загрузить вопросы один раз при старте, а не при каждом вызове /quiz.
+    Возвращает False, если загрузить вопросы не удалось (банк в bot_data при этом не меняется).
+    """
+    # Время начала загрузки запоминается: с него начинается опрос изменений, если change stream недоступен.
+    loaded_at = datetime.now(timezone.utc)
+    # Для change stream нужно время кластера: на replica set его возвращает любая команда (operationTime).
+    # Поток изменений открывается с этого момента, поэтому правки, сделанные во время загрузки, не теряются
+    # (попавшие и в загрузку, и в поток применяются повторно, что безопасно).
+    try:
+        operation_time = (await mongo_client.admin.command('ping')).get("operationTime")
+    except Exception as e:
+        logger.warning("Не удалось получить время кластера MongoDB: %s", e)
+        operation_time = None
+    # Индексы MongoDB по полям выбора соответствуют индексу в памяти и нужны для выборок администраторов.
+    for field in QUESTION_FILTER_FIELDS:
+        try:
+            await questions_collection.create_index(field)
+        except Exception as e:
+            logger.warning("Не удалось создать индекс на %s: %s", field, e)
     loaded_questions = await load_questions_from_db()
-    application.bot_data['quiz_questions'] = loaded_questions
+    if loaded_questions is None:
+        return False
+    # Индекс по полям выбора строится в рабочем потоке, чтобы не останавливать event loop на большом банке.
+    bank = await asyncio.to_thread(QuestionBank.from_questions, loaded_questions)
+    bot_data['question_bank'] = bank
+    bot_data['questions_loaded_at'] = loaded_at
+    bot_data['questions_operation_time'] = operation_time
     if not loaded_questions:
-        logger.warning("Внимание: нет корректных вопросов в базе данных или не удалось их загрузить. Викторина будет пуста.")
+        logger.warning("Внимание: нет корректных вопросов в базе данных. Викторина будет пуста.")
     else:
-        logger.info(f"Успешно загружено {len(loaded_questions)} вопросов в bot_data при запуске.")
+        logger.info("Успешно загружено %s вопросов в bot_data.", len(loaded_questions))
+    if QUESTIONS_SNAPSHOT_PATH:
+        # В режиме нескольких процессов вопросы читаются из отображенного в память снимка: его страницы
+        # общие для всех процессов. Список объектов Python, унаследованный через fork, копировался бы в каждый
+        # процесс постепенно: даже чтение вопроса меняет счетчик ссылок и копирует страницу памяти.
+        try:
+            shared = await asyncio.to_thread(write_question_snapshot, bank, QUESTIONS_SNAPSHOT_PATH, WORKER_PROCESSES > 1)
+        except OSError as e:
+            logger.warning("Не удалось записать снимок банка вопросов %s: %s", QUESTIONS_SNAPSHOT_PATH, e)
+        else:
+            if shared is not None:
+                bot_data['question_bank'] = shared
+    return True
 
 
-def main() -> None:
+async def start_metrics_server(application: Application) -> None:
     """
-    Основная функция. Запускает бота.
+    Регистрирует метрики текущего состояния бота и, если задан METRICS_PORT, запускает HTTP-эндпоинт метрик.
     """
-    logger.info("Инициализация приложения бота...")
-    # Создаем экземпляр Application (основной объект бота) с помощью ApplicationBuilder.
-    # .token(TOKEN) - устанавливает токен бота.
+    metrics.gauge("histeye_active_sessions", "Викторины, активные в памяти.", lambda: len(session_store))
+    metrics.gauge("histeye_expired_sessions_total", "Сессии, удаленные из-за простоя.", lambda: session_store.expired_count, "counter")
+    metrics.gauge("histeye_evicted_sessions_total", "Сессии, вытесненные из памяти из-за ограничения размера.", lambda: session_store.evicted_count, "counter")
+    metrics.gauge("histeye_question_bank_size", "Вопросы в банке.",
+                  lambda: len(application.bot_data.get('question_bank', EMPTY_QUESTION_BANK)))
+    metrics.gauge("histeye_stats_pending", "Вопросы и пользователи с несохраненными приращениями статистики.", lambda: len(stats))
+    metrics.gauge("histeye_outbound_queue_length", "Запросы к Telegram, ожидающие отправки.", lambda: len(outbound))
+    metrics.gauge("histeye_log_records_dropped_total", "Записи лога, отброшенные из-за переполнения очереди вывода.",
+                  lambda: log_handler.dropped, "counter")
+    if METRICS_PORT is None:
+        return
+    application.bot_data['metrics_server'] = await asyncio.start_server(handle_metrics_request, METRICS_LISTEN, METRICS_PORT)
+    logger.info("Метрики доступны по адресу http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+
+
+async def post_shutdown_cleanup(application: Application) -> None:
+    """
+    Асинхронная функция, выполняемая при остановке бота.
+    Останавливает фоновые задачи, запущенные в post_init_setup, и сохраняет последние изменения сессий.
+    """
+    tasks = application.bot_data.get('background_tasks', [])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True) # Дожидаемся завершения отмененных задач.
+    await outbound.stop() # Отправляем сообщения, оставшиеся в очереди.
+    metrics_server = application.bot_data.get('metrics_server')
+    if metrics_server is not None:
+        metrics_server.close()
+    await session_store.flush() # Записываем изменения, накопленные с последнего периодического сброса.
+    await stats.flush()
+
+
+def build_application(token=TOKEN, base_url=None, updater=True) -> Application:
+    """
+    Создает Application (основной объект бота) и регистрирует обработчики.
+    base_url - адрес сервера Bot API; по умолчанию используется api.telegram.org.
+    Другой адрес нужен, например, для нагрузочного теста с локальным сервером (benchmark.py).
+    updater=False - приложение само не получает обновления от Telegram (процесс-обработчик в режиме нескольких процессов).
+    """
+    # Создаем экземпляр Application с помощью ApplicationBuilder.
+    # .token(token) - устанавливает токен бота.
     # .post_init(post_init_setup) - регистрирует функцию, которая выполнится после инициализации, но до запуска поллинга.
-    application = ApplicationBuilder().token(TOKEN).post_init(post_init_setup).build()
+    # .post_shutdown(post_shutdown_cleanup) - регистрирует функцию, которая выполнится при остановке бота.
+    # .concurrent_updates(...) - обновления разных пользователей обрабатываются параллельно, одного - по очереди.
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .post_init(post_init_setup)
+        .post_shutdown(post_shutdown_cleanup)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
 
     # Регистрируем обработчики команд.
     # CommandHandler("start", start) означает: когда бот получит команду /start, вызвать функцию start.
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("quiz", quiz))
+    application.add_handler(CommandHandler("top", top))
 
     # Регистрируем обработчик для нажатий на inline-кнопки.
     # CallbackQueryHandler(check_answer) означает: при любом нажатии на inline-кнопку вызвать функцию check_answer.
     application.add_handler(CallbackQueryHandler(check_answer))
+    return application
+
+
+# --- РЕЖИМ НЕСКОЛЬКИХ ПРОЦЕССОВ ---
+# Основной процесс (ingress) получает обновления и раскладывает их по очередям процессов-обработчиков
+# по ID пользователя. Каждый обработчик - обычное приложение бота со своим event loop, своими сессиями
+# и очередью исходящих запросов, но без собственного получения обновлений.
+
+async def preload_question_bank():
+    """
+    Загружает банк вопросов в основном процессе до запуска обработчиков. Возвращает словарь для bot_data обработчиков.
+    Если MongoDB недоступна, обработчики начинают работу с локальным снимком и загружают вопросы из БД сами, в фоне.
+    """
+    bot_data = {}
+    if await connect_to_mongodb():
+        await load_question_bank(bot_data)
+    if mongo_client is not None:
+        mongo_client.close() # Соединения MongoDB не переживают fork: каждый обработчик подключается заново.
+    if 'question_bank' not in bot_data:
+        bot_data['question_bank'] = load_question_snapshot(QUESTIONS_SNAPSHOT_PATH) or EMPTY_QUESTION_BANK
+    return bot_data
+
+
+def start_workers(bot_data, token=TOKEN, base_url=None):
+    """
+    Запускает WORKER_PROCESSES процессов-обработчиков через fork. Возвращает (очереди обновлений, процессы).
+    Процессы наследуют уже загруженный банк вопросов из bot_data. Если задан QUESTIONS_SNAPSHOT_PATH, это банк
+    из отображенного в память снимка (см. load_question_bank): вопросы действительно общие для всех процессов,
+    а в памяти каждого процесса - только индекс по полям выбора (около 12 байт на вопрос), правки и кэш
+    декодированных вопросов. Без снимка наследуется обычный список вопросов: страницы с ним общие только
+    до первого обращения, а чтение вопросов и правки постепенно копируют банк в каждый процесс.
+    """
+    # Объекты основного процесса переводятся в постоянное поколение сборщика мусора: иначе первая же сборка
+    # в каждом обработчике записала бы в их заголовки и скопировала страницы, которые иначе остались бы общими.
+    gc.freeze()
+    context = multiprocessing.get_context("fork")
+    queues = [context.Queue(WORKER_QUEUE_SIZE) for _ in range(WORKER_PROCESSES)]
+    processes = [
+        context.Process(target=worker_main, args=(index, queues[index], bot_data, token, base_url), name=f"quiz-worker-{index}")
+        for index in range(WORKER_PROCESSES)
+    ]
+    # Поток вывода логов останавливается на время fork: если бы в момент fork он держал блокировку очереди лога
+    # или потока вывода, обработчик завис бы на первой же записи лога. Записи, сделанные за это время,
+    # остаются в очереди и выводятся после перезапуска потока; обработчики настраивают логи заново (worker_main).
+    log_handler.listener.stop()
+    try:
+        for process in processes:
+            process.start()
+    finally:
+        log_handler.listener.start()
+    gc.unfreeze() # В основном процессе банк больше не нужен: пусть собирается как обычно.
+    logger.info("Запущено %s процессов-обработчиков.", WORKER_PROCESSES)
+    return queues, processes
+
+
+def worker_main(worker_index, updates, bot_data, token, base_url) -> None:
+    """Точка входа процесса-обработчика."""
+    global log_handler, outbound, session_store, stats, mongo_client, db, questions_collection, METRICS_PORT
+    # Ctrl+C получает вся группа процессов; обработчик останавливается по сигналу от основного процесса,
+    # чтобы успеть обработать уже полученные обновления и сохранить сессии.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Поток вывода логов не переживает fork: запускаем свой.
+    logging.getLogger().removeHandler(log_handler)
+    log_handler = configure_logging()
+    # Состояние, относящееся к процессу, создается заново; общий лимит отправки делится между обработчиками.
+    outbound = OutboundDispatcher(OUTBOUND_GLOBAL_RATE / WORKER_PROCESSES)
+    session_store = SessionStore()
+    stats = StatsStore()
+    mongo_client = db = questions_collection = None
+    if METRICS_PORT is not None: # Каждый обработчик отдает свои метрики на отдельном порту.
+        METRICS_PORT += worker_index
+    try:
+        asyncio.run(run_worker(worker_index, updates, bot_data, token, base_url))
+    finally:
+        log_handler.listener.stop() # Процесс multiprocessing завершается без atexit: выводим оставшиеся записи лога.
+
+
+async def run_worker(worker_index, updates, bot_data, token, base_url) -> None:
+    """
+    Обрабатывает обновления из очереди updates, пока основной процесс не пришлет None.
+    Очередь читается отдельным потоком, чтобы ожидание не останавливало event loop.
+    """
+    application = build_application(token, base_url, updater=False)
+    application.bot_data.update(bot_data)
+    loop = asyncio.get_running_loop()
+    finished = asyncio.Event()
+
+    def deliver(data):
+        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+    def receive():
+        while (data := updates.get()) is not None:
+            loop.call_soon_threadsafe(deliver, data)
+        loop.call_soon_threadsafe(finished.set)
+
+    await application.initialize()
+    await post_init_setup(application)
+    await application.start()
+    threading.Thread(target=receive, name="updates-reader", daemon=True).start()
+    logger.info("Процесс-обработчик %s готов принимать обновления.", worker_index)
+    await finished.wait()
+    await application.stop()
+    await post_shutdown_cleanup(application)
+    await application.shutdown()
+
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Передает обновление процессу-обработчику, закрепленному за пользователем (ID пользователя по модулю числа процессов).
+    Обновления в основном процессе обрабатываются по одному, поэтому порядок обновлений пользователя сохраняется.
+    """
+    queues = context.bot_data['worker_queues']
+    user = update.effective_user
+    key = user.id if user else (update.effective_chat.id if update.effective_chat else 0)
+    target = queues[key % len(queues)]
+    data = update.to_dict()
+    try:
+        target.put_nowait(data)
+    except queue.Full: # Обработчик не успевает: ждем места в очереди, не останавливая event loop.
+        await asyncio.to_thread(target.put, data)
+
+
+async def stop_workers(application: Application) -> None:
+    """Останавливает процессы-обработчики после остановки получения обновлений."""
+    for updates in application.bot_data['worker_queues']:
+        updates.put(None)
+    for process in application.bot_data['worker_processes']:
+        await asyncio.to_thread(process.join, WORKER_SHUTDOWN_TIMEOUT)
+        if process.is_alive():
+            logger.warning("Процесс-обработчик %s не завершился за %s с и будет остановлен принудительно.", process.name, WORKER_SHUTDOWN_TIMEOUT)
+            process.terminate()
+
+
+def build_ingress_application(queues, processes, token=TOKEN, base_url=None) -> Application:
+    """Создает приложение основного процесса: оно только получает обновления и передает их обработчикам."""
+    builder = ApplicationBuilder().token(token).post_shutdown(stop_workers)
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    application.bot_data['worker_queues'] = queues
+    application.bot_data['worker_processes'] = processes
+    application.add_handler(TypeHandler(Update, route_update))
+    return application
+
+
+def main() -> None:
+    """
+    Основная функция. Запускает бота.
+    """
+    logger.info("Инициализация приложения бота...")
+    if WORKER_PROCESSES > 1:
+        bot_data = asyncio.run(preload_question_bank())
+        application = build_ingress_application(*start_workers(bot_data))
+    else:
+        application = build_application()
 
     logger.info("Бот запущен и готов принимать обновления...")
-    # Запускаем бота. Он начинает постоянно опрашивать серверы Telegram на наличие новых сообщений (поллинг).
-    # allowed_updates=Update.ALL_TYPES - бот будет получать все типы обновлений.
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # allowed_updates=ALLOWED_UPDATES - бот получает только сообщения и нажатия кнопок.
+    if USE_WEBHOOK:
+        # Запускаем локальный HTTP-сервер и сообщаем Telegram адрес, на который присылать обновления.
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        # Запускаем бота. Он начинает постоянно опрашивать серверы Telegram на наличие новых сообщений (поллинг).
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':